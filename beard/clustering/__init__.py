@@ -10,13 +10,27 @@
 """Clustering algorithms."""
 
 from .blocking import BlockClustering
+from .blocking import plan_blocking
+from .blocking_funcs import BlockingIndex
 from .blocking_funcs import block_phonetic
 from .blocking_funcs import block_last_name_first_initial
 from .blocking_funcs import block_single
+from .blocking_funcs import block_sorted_neighbourhood
+from .blocking_funcs import encode_blocks
+from .blocking_funcs import block_size_histogram
+from .pool import WorkerPool
+from .wrappers import ConnectedComponentsClustering
 from .wrappers import ScipyHierarchicalClustering
 
 __all__ = ("BlockClustering",
+           "BlockingIndex",
            "block_phonetic",
            "block_last_name_first_initial",
            "block_single",
+           "block_sorted_neighbourhood",
+           "encode_blocks",
+           "block_size_histogram",
+           "plan_blocking",
+           "WorkerPool",
+           "ConnectedComponentsClustering",
            "ScipyHierarchicalClustering")
@@ -16,76 +16,456 @@
 
 from __future__ import print_function
 
-import multiprocessing as mp
 import numpy as np
+import os
+import shutil
+import tempfile
 import time
 
+from six.moves import cPickle as pickle
+
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
 from sklearn.base import BaseEstimator
-from sklearn.base import clone
 from sklearn.base import ClusterMixin
+from sklearn.utils import check_random_state
 from sklearn.utils import column_or_1d
 
+from .blocking_funcs import block_last_name_first_initial
+from .blocking_funcs import block_phonetic
 from .blocking_funcs import block_single
+from .pool import _SharedBlocks
+from .pool import _Task
+from .pool import WorkerPool
 
-try:
-    from multiprocessing import SimpleQueue
-except ImportError:
-    from multiprocessing.queues import SimpleQueue
 
+class _BlockIndex(object):
 
-class _SingleClustering(BaseEstimator, ClusterMixin):
-    def fit(self, X, y=None):
-        self.labels_ = block_single(X)
-        return self
+    """Index of the samples belonging to each block.
+
+    The index is built with a single sort of the block keys, instead of one
+    comparison of the whole array of keys per block. The samples of the
+    i-th block are then ``order[offsets[i]:offsets[i + 1]]``, in increasing
+    order.
+
+    Samples may belong to several blocks, if given several keys. The blocks
+    then overlap and ``order`` contains such samples several times.
+    """
+
+    def __init__(self, blocks):
+        """Build the index.
+
+        Parameters
+        ----------
+        :param blocks: array-like, shape (n_samples, ) or (n_samples, n_keys)
+            Array of keys mapping samples to blocks. Samples belonging to
+            several blocks have a row of keys, or a list, tuple or set of
+            keys in an array of objects.
+        """
+        blocks = np.asarray(blocks)
+        sample_ids = None
+
+        if blocks.ndim == 2:
+            sample_ids = np.repeat(np.arange(len(blocks)), blocks.shape[1])
+            blocks = blocks.ravel()
+
+        elif (blocks.dtype == np.object and len(blocks) > 0 and
+              isinstance(blocks[0], (list, tuple, set, frozenset))):
+            sample_ids = np.repeat(np.arange(len(blocks)),
+                                   [len(keys) for keys in blocks])
+            blocks = np.array([key for keys in blocks for key in keys])
+
+        self.overlapping = sample_ids is not None
+        self.keys, inverse = np.unique(blocks, return_inverse=True)
+
+        if self.overlapping:
+            # Sort by block, then by sample, and drop repeated keys
+            order = np.lexsort((sample_ids, inverse))
+            inverse, sample_ids = inverse[order], sample_ids[order]
+            repeated = ((inverse[1:] == inverse[:-1]) &
+                        (sample_ids[1:] == sample_ids[:-1]))
+            inverse = np.delete(inverse, np.flatnonzero(repeated) + 1)
+            self.order = np.delete(sample_ids, np.flatnonzero(repeated) + 1)
+        else:
+            self.order = np.argsort(inverse, kind="mergesort")
+
+        self.sizes = np.bincount(inverse, minlength=len(self.keys))
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes)))
+
+    def __len__(self):
+        """Get the number of blocks."""
+        return len(self.keys)
+
+    def samples(self, i):
+        """Get the indices of the samples of the i-th block."""
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+
+def _reconcile(n_samples, assignments, n_clusters):
+    """Merge the clusters of overlapping blocks into global labels.
+
+    Clusters sharing a sample are merged, transitively. This is computed
+    as the connected components of the bipartite graph linking the samples
+    to their clusters.
+
+    Parameters
+    ----------
+    :param n_samples: int
+        Number of samples.
+    :param assignments: list
+        Pairs of arrays ``(samples, labels)``, the labels of the samples of
+        every block, made distinct across blocks. Label -1 stands for no
+        cluster.
+    :param n_clusters: int
+        Number of distinct labels.
+
+    Returns
+    -------
+    :returns: numpy array, shape (n_samples, )
+        The labels, or -1 for samples without any cluster.
+    """
+    labels = -np.ones(n_samples, dtype=np.int)
+
+    if not assignments:
+        return labels
+
+    samples = np.concatenate([samples for samples, _ in assignments])
+    clusters = np.concatenate([pred for _, pred in assignments])
+    samples, clusters = samples[clusters != -1], clusters[clusters != -1]
+
+    n_nodes = n_samples + n_clusters
+    graph = coo_matrix((np.ones(len(samples)),
+                        (samples, n_samples + clusters)),
+                       shape=(n_nodes, n_nodes))
+    _, components = connected_components(graph, directed=False)
+
+    clustered = np.zeros(n_samples, dtype=np.bool)
+    clustered[samples] = True
+    labels[clustered] = np.unique(components[:n_samples][clustered],
+                                  return_inverse=True)[1]
+
+    return labels
+
+
+def _is_encoded(blocks):
+    """Check whether blocks are a pair of integer ids and block names."""
+    return (isinstance(blocks, tuple) and len(blocks) == 2 and
+            isinstance(blocks[0], np.ndarray))
 
-    def partial_fit(self, X, y=None):
-        self.labels_ = block_single(X)
-        return self
 
-    def predict(self, X):
-        return block_single(X)
+def _blocks_names(blocking):
+    """Check whether a blocking function only reads the author names.
 
+    Such a function, possibly given with its parameters in a
+    functools.partial, can block all the samples of a stream at once from
+    their names only.
+    """
+    func = getattr(blocking, "func", blocking)
+    return func is block_phonetic or func is block_last_name_first_initial
+
+
+class _SpilledBlocks(object):
+
+    """Samples of a stream, written to disk and grouped by block.
+
+    Every block has its own file, to which the samples of each chunk of the
+    stream are appended. A block can therefore be read back without loading
+    the rest of the data.
+    """
+
+    def __init__(self, directory=None):
+        """Create the directory of the files.
+
+        Parameters
+        ----------
+        :param directory: string or None
+            Directory in which a temporary directory is created. If None, the
+            default location for temporary files is used.
+        """
+        self.directory = tempfile.mkdtemp(prefix="beard-", dir=directory)
+        self._paths = {}
+        self._stream = os.path.join(self.directory, "stream.pkl")
+
+    def hold(self, X, y):
+        """Append a chunk of samples whose blocks are not known yet."""
+        with open(self._stream, "ab") as f:
+            pickle.dump((X, y), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def held(self):
+        """Read back the chunks written by `hold`, in the order of the stream.
+
+        Returns
+        -------
+        :returns: generator
+            Pairs ``(X, y)``. The file is removed once read.
+        """
+        if not os.path.exists(self._stream):
+            return
+
+        with open(self._stream, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
 
-def _parallel_fit(fit_, partial_fit_, estimator, verbose, data_queue,
-                  result_queue):
-    """Run clusterer's fit function."""
-    # Status can be one of: 'middle', 'end'
-    # 'middle' means that there is a block to compute and the process should
-    # continue
-    # 'end' means that the process should finish as all the data was sent
-    # by the main process
-    status, block, existing_clusterer = data_queue.get()
+        os.remove(self._stream)
+
+    def add(self, X, y, blocks):
+        """Append a chunk of samples to the files of their blocks.
+
+        Parameters
+        ----------
+        :param X: numpy array
+            Samples of the chunk.
+        :param y: numpy array or None
+            Labels of the samples of the chunk.
+        :param blocks: numpy array
+            Block keys of the samples of the chunk.
+        """
+        index = _BlockIndex(blocks)
+
+        for i, b in enumerate(index.keys):
+            samples = index.samples(i)
+
+            if b not in self._paths:
+                self._paths[b] = os.path.join(self.directory,
+                                              "%d.pkl" % len(self._paths))
+
+            with open(self._paths[b], "ab") as f:
+                pickle.dump((X[samples],
+                             y[samples] if y is not None else None), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, b):
+        """Read back all the samples of block ``b``.
+
+        Returns
+        -------
+        :returns: tuple
+            Samples and labels of the block, in the order of the stream.
+        """
+        chunks = []
 
-    while status != 'end':
+        with open(self._paths[b], "rb") as f:
+            while True:
+                try:
+                    chunks.append(pickle.load(f))
+                except EOFError:
+                    break
 
-        b, X, y = block
+        X, y = zip(*chunks)
 
-        if len(X) == 1:
-            clusterer = _SingleClustering()
-        elif existing_clusterer and partial_fit_ and not fit_:
-            clusterer = existing_clusterer
+        if y[0] is None:
+            y = None
         else:
-            clusterer = clone(estimator)
+            y = np.concatenate(y)
 
-        if verbose > 1:
-            print("Clustering %d samples on block '%s'..." % (len(X), b))
+        return np.concatenate(X), y
 
-        if fit_ or not hasattr(clusterer, "partial_fit"):
-            try:
-                clusterer.fit(X, y=y)
-            except TypeError:
-                clusterer.fit(X)
-        elif partial_fit_:
-            try:
-                clusterer.partial_fit(X, y=y)
-            except TypeError:
-                clusterer.partial_fit(X)
+    def close(self):
+        """Remove the files."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class FitSummary(object):
+
+    """Summary of the fitting of the blocks by BlockClustering.
+
+    Attributes
+    ----------
+    events : list of dict
+        Measurements of every block, in the order of completion. See the
+        `callback` parameter of BlockClustering for their keys.
+
+    n_blocks : int
+        Number of fitted blocks.
+
+    n_samples : int
+        Number of samples in the fitted blocks.
+
+    n_failed : int
+        Number of blocks whose fitting failed.
+
+    wall_time : float
+        Wall time in seconds of the fitting.
+
+    fit_time : float
+        Sum of the time in seconds spent by the workers on fitting.
+
+    max_queue_wait : float
+        Longest time in seconds a block waited before a worker started it.
+
+    peak_rss : int or None
+        Largest peak resident set size of the workers, in bytes.
+    """
+
+    def __init__(self, events, wall_time):
+        """Summarize the measurements of the blocks.
+
+        Parameters
+        ----------
+        :param events: list of dict
+            Measurements of every block.
+        :param wall_time: float
+            Wall time in seconds of the fitting.
+        """
+        self.events = events
+        self.wall_time = wall_time
+        self.n_blocks = len(events)
+        self.n_samples = sum(e["n_samples"] or 0 for e in events)
+        self.n_failed = sum(1 for e in events if e.get("error"))
+        self.fit_time = sum(e["fit_time"] for e in events)
+        self.max_queue_wait = max([e["queue_wait"] for e in events] or [0.])
+
+        peak_rss = [e["peak_rss"] for e in events if e["peak_rss"]]
+        self.peak_rss = max(peak_rss) if peak_rss else None
+
+    def slowest(self, n=10):
+        """Get the measurements of the ``n`` blocks slowest to fit."""
+        return sorted(self.events, key=lambda e: -e["fit_time"])[:n]
+
+    def __repr__(self):
+        """Describe the summary."""
+        return ("FitSummary(n_blocks=%d, n_samples=%d, n_failed=%d, "
+                "wall_time=%.3f, fit_time=%.3f, max_queue_wait=%.3f, "
+                "peak_rss=%s)" % (
+                    self.n_blocks, self.n_samples, self.n_failed,
+                    self.wall_time, self.fit_time, self.max_queue_wait,
+                    self.peak_rss))
+
+
+class BlockingPlan(object):
+
+    """Estimated cost of clustering the blocks of a blocking strategy.
+
+    Attributes
+    ----------
+    n_samples : int
+        Number of samples to cluster.
+
+    n_sampled : int
+        Number of samples on which the blocking was run.
+
+    n_blocks : int
+        Number of blocks of the sampled samples.
+
+    sizes : numpy array
+        Estimated size of every block, i.e. its number of sampled samples
+        scaled by ``n_samples / n_sampled``.
+
+    max_size : float
+        Estimated size of the largest block.
+
+    sum_squares : float
+        Estimated sum of N_b^2 over the blocks.
+
+    n_pairs : float
+        Estimated number of pairs of samples within the blocks, i.e. of
+        pairwise distances to compute.
+
+    peak_memory : float
+        Estimated memory in bytes of the square distance matrix of the
+        largest block.
+
+    time : float or None
+        Estimated time in seconds of computing the pairwise distances, if a
+        cost per pair was given.
+    """
+
+    def __init__(self, blocks, n_samples, pair_cost=None, pair_bytes=8):
+        """Estimate the cost of clustering ``blocks``.
+
+        Parameters
+        ----------
+        :param blocks: array-like or tuple
+            Block keys of the sampled samples, as given by a blocking
+            function, possibly as integer ids with their names.
+        :param n_samples: int
+            Number of samples to cluster.
+        :param pair_cost: float or None
+            Time in seconds of computing the distance of a pair of samples.
+        :param pair_bytes: int
+            Memory in bytes of an entry of a distance matrix.
+        """
+        if _is_encoded(blocks):
+            blocks = blocks[0]
+
+        index = _BlockIndex(blocks)
+        scale = float(n_samples) / max(len(blocks), 1)
+
+        self.n_samples = n_samples
+        self.n_sampled = len(blocks)
+        self.n_blocks = len(index)
+        self.sizes = index.sizes * scale
+        self.max_size = self.sizes.max() if len(index) > 0 else 0.
+        self.sum_squares = np.sum(self.sizes ** 2)
+        self.n_pairs = np.sum(self.sizes * (self.sizes - 1) / 2.)
+        self.peak_memory = self.max_size ** 2 * pair_bytes
+        self.time = (self.n_pairs * pair_cost
+                     if pair_cost is not None else None)
+
+    def histogram(self):
+        """Get the distinct estimated block sizes and their numbers."""
+        return np.unique(self.sizes, return_counts=True)
+
+    def __repr__(self):
+        """Describe the plan."""
+        return ("BlockingPlan(n_samples=%d, n_sampled=%d, n_blocks=%d, "
+                "max_size=%.0f, sum_squares=%.4g, n_pairs=%.4g, "
+                "peak_memory=%.4g, time=%s)" % (
+                    self.n_samples, self.n_sampled, self.n_blocks,
+                    self.max_size, self.sum_squares, self.n_pairs,
+                    self.peak_memory, self.time))
+
+
+def plan_blocking(X, blocking, sample=None, pair_cost=None, pair_bytes=8,
+                  random_state=None):
+    """Estimate the cost of a blocking strategy, without clustering.
+
+    Only the blocking function is run, possibly on a random sample of X.
+    The sizes of the blocks of the sample are then scaled to the size of X.
+    Note that blocking functions splitting blocks above a threshold produce
+    larger blocks on a sample than on the whole data.
+
+    Parameters
+    ----------
+    :param X: numpy array
+        Samples to block.
+    :param blocking: callable
+        Blocking function, as given to BlockClustering.
+    :param sample: int, float or None
+        Number of samples, or fraction of the samples if a float, on which
+        to run the blocking. If None, all the samples are used.
+    :param pair_cost: float or None
+        Time in seconds of computing the distance of a pair of samples, e.g.
+        measured on a few blocks, for estimating the total time.
+    :param pair_bytes: int
+        Memory in bytes of an entry of a distance matrix.
+    :param random_state: int or RandomState
+        Random number generator for drawing the sample.
+
+    Returns
+    -------
+    :returns: BlockingPlan
+        The estimated number and sizes of the blocks, number of pairs,
+        memory and time.
+    """
+    n_samples = len(X)
+
+    if sample is not None:
+        if isinstance(sample, float):
+            sample = int(round(sample * n_samples))
+        if not 0 < sample <= n_samples:
+            raise ValueError("Invalid value for sample. It must be between "
+                             "1 and the number of samples, or a fraction.")
 
-        result_queue.put((b, clusterer))
-        status, block, existing_clusterer = data_queue.get()
+        rng = check_random_state(random_state)
+        X = X[np.sort(rng.choice(n_samples, sample, replace=False))]
 
-    data_queue.put(('end', None, None))
-    return
+    return BlockingPlan(blocking(X), n_samples, pair_cost=pair_cost,
+                        pair_bytes=pair_bytes)
 
 
 class BlockClustering(BaseEstimator, ClusterMixin):
@@ -102,14 +482,39 @@ class BlockClustering(BaseEstimator, ClusterMixin):
     labels_ : ndarray, shape (n_samples,)
         Array of labels assigned to the input data.
         if partial_fit is used instead of fit, they are assigned to the
-        last batch of data.
+        last batch of data. The labels are computed on the first access and
+        cached until the next call to `fit`, `partial_fit` or
+        `clear_labels_cache`.
 
     blocks_ : ndarray, shape (n_samples,)
         Array of keys mapping input data to blocks.
+
+    block_fit_times_ : dict
+        Time in seconds spent on fitting the clusterer of each block during
+        the last call to `fit` or `partial_fit`.
+
+    fit_time_ : float
+        Wall time in seconds of the last call to `fit` or `partial_fit`.
+
+    fit_summary_ : FitSummary
+        Measurements of the blocks during the last call to `fit` or
+        `partial_fit`, e.g. for finding the blocks dominating the time or
+        the memory.
+
+    block_vocabulary_ : list or None
+        Names of the blocks, indexed by the keys of `clusterers_`, when the
+        blocks are given as integer ids with their names.
+
+    failed_blocks_ : dict
+        Formatted traceback of every block whose fitting failed during the
+        last call to `fit` or `partial_fit`, when on_error="skip". The
+        samples of these blocks are labeled -1.
     """
 
     def __init__(self, affinity=None, blocking="single", base_estimator=None,
-                 verbose=0, n_jobs=1):
+                 verbose=0, n_jobs=1, pool=None, schedule="lexicographic",
+                 transport="pickle", backend="processes", callback=None,
+                 on_error="raise", checkpoint=None, checkpoint_every=100):
         """Initialize.
 
         Parameters
@@ -125,6 +530,15 @@ class BlockClustering(BaseEstimator, ClusterMixin):
               or `predict`) as a key for mapping sample X[i] to a block;
             - callable: use blocking(X)[i] as a key for mapping sample X[i] to
               a block.
+            Blocks can also be given as a pair ``(ids, vocabulary)`` of an
+            array of integer ids and the block names they index, e.g. from a
+            blocking function called with ``return_ids=True``. The ids are
+            then mapped to `block_vocabulary_`, consistently across calls.
+            A sample may belong to several blocks, e.g. to the blocks of both
+            its first and its last surname, if its blocks are a row of a 2-D
+            array of keys or a list, tuple or set of keys. Every block is
+            clustered independently, and clusters sharing a sample are then
+            merged in `labels_`. `predict` is not available in that case.
 
         :param base_estimator: estimator
             Clustering estimator to fit within each block.
@@ -133,34 +547,162 @@ class BlockClustering(BaseEstimator, ClusterMixin):
             Verbosity of the fitting procedure.
 
         :param n_jobs: int
-            Number of processes to use.
+            Number of workers to use.
+
+        :param pool: None, "persistent" or WorkerPool
+            The workers fitting the blocks.
+            - None: start `n_jobs` workers at the beginning of every call to
+              `fit` or `partial_fit` and shut them down at the end;
+            - "persistent": start `n_jobs` workers on the first call and keep
+              them alive across calls, until `close` is called;
+            - WorkerPool: use the given pool, which is left running.
+
+        :param schedule: string, default "lexicographic"
+            The order in which the blocks are sent to the workers.
+            - "lexicographic": in the order of the block keys;
+            - "largest_first": by decreasing estimated cost N_b^2, so that
+              the largest blocks don't delay the end of the computation.
+
+        :param transport: string, default "pickle"
+            How the data is exchanged with the workers.
+            - "pickle": the data of every block is pickled to the worker and
+              the fitted clusterer is pickled back;
+            - "shared": X is written once to a temporary directory, ordered
+              by block, and each worker loads only the range of its block.
+              Only the labels are sent back, hence `predict` and
+              `partial_fit` are not available. Numerical arrays are
+              memory-mapped by the workers, while arrays of objects, e.g. of
+              signatures, are still pickled block by block and cost as much
+              to send as with "pickle".
+
+        :param backend: string, default "processes"
+            The kind of workers, unless a WorkerPool is given in `pool`.
+            - "processes": fit the blocks in `n_jobs` processes;
+            - "threads": fit the blocks in `n_jobs` threads, which is
+              cheaper when the base estimator releases the GIL;
+            - "serial": fit the blocks one after the other, in the calling
+              thread.
+
+        :param callback: callable or None
+            Function called in the main process with the measurements of
+            every block, as soon as the block is fitted. The measurements
+            are a dictionary with the keys "block", "n_samples", "worker"
+            (index of the worker in the pool), "pid", "queue_wait" and
+            "fit_time" (in seconds) and "peak_rss" (peak resident set size
+            of the worker process so far, in bytes, or None) and "error"
+            (formatted traceback if the fitting failed, else None).
+
+        :param on_error: string, default "raise"
+            What to do when the fitting of a block raises an exception, or
+            when its worker dies more often than allowed by the pool.
+            - "raise": raise a RuntimeError, once the running blocks are
+              finished;
+            - "skip": record the error in `failed_blocks_`, label the samples
+              of the block -1 and continue with the other blocks.
+
+        :param checkpoint: string or None
+            Directory where the fitted clusterers are saved while fitting.
+            When `fit` or `fit_stream` is called again with the same
+            directory, blocks whose clusterer is found there with the same
+            number of samples are not fitted again. The directory must be
+            removed to start afresh.
+
+        :param checkpoint_every: int, default 100
+            Number of fitted blocks between two writes to `checkpoint`.
         """
         self.affinity = affinity
         self.blocking = blocking
         self.base_estimator = base_estimator
         self.verbose = verbose
         self.n_jobs = n_jobs
-
-    def _validate(self, X, blocks):
-        """Validate hyper-parameters and input data."""
+        self.pool = pool
+        self.schedule = schedule
+        self.transport = transport
+        self.backend = backend
+        self.callback = callback
+        self.on_error = on_error
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+
+    def _validate(self, X, blocks, fitting=True):
+        """Validate hyper-parameters and input data.
+
+        Block names given with integer ids are added to `block_vocabulary_`
+        only when ``fitting``.
+        """
         if self.blocking == "single":
             blocks = block_single(X)
         elif self.blocking == "precomputed":
+            if _is_encoded(blocks):
+                blocks = self._merge_vocabulary(*blocks, fitting=fitting)
             if blocks is not None and len(blocks) == len(X):
-                blocks = column_or_1d(blocks).ravel()
+                if np.ndim(blocks) != 2:
+                    blocks = column_or_1d(blocks).ravel()
             else:
                 raise ValueError("Invalid value for blocks. When "
                                  "blocking='precomputed', blocks needs to be "
                                  "an array of size len(X).")
         elif callable(self.blocking):
             blocks = self.blocking(X)
+            if _is_encoded(blocks):
+                blocks = self._merge_vocabulary(*blocks, fitting=fitting)
         else:
             raise ValueError("Invalid value for blocking. Allowed values are "
                              "'single', 'precomputed' or callable.")
 
+        if self.schedule not in ("lexicographic", "largest_first"):
+            raise ValueError("Invalid value for schedule. Allowed values are "
+                             "'lexicographic' or 'largest_first'.")
+
+        if self.transport not in ("pickle", "shared"):
+            raise ValueError("Invalid value for transport. Allowed values are "
+                             "'pickle' or 'shared'.")
+
+        if self.on_error not in ("raise", "skip"):
+            raise ValueError("Invalid value for on_error. Allowed values are "
+                             "'raise' or 'skip'.")
+
         return X, blocks
 
-    def _blocks(self, X, y, blocks):
+    def _merge_vocabulary(self, ids, vocabulary, fitting=True):
+        """Map integer block ids to consistent ids across calls.
+
+        Parameters
+        ----------
+        :param ids: numpy array of integers
+            Block ids, indexing ``vocabulary``.
+        :param vocabulary: array-like
+            Block names.
+        :param fitting: boolean
+            Whether to extend `block_vocabulary_` with the new block names.
+            Otherwise, they get the id -1, of no fitted block.
+
+        Returns
+        -------
+        :returns: numpy array of int32
+            The block ids, indexing `block_vocabulary_`.
+        """
+        if getattr(self, "block_vocabulary_", None) is None:
+            if not fitting:
+                return np.full(np.shape(ids), -1, dtype=np.int32)
+
+            self.block_vocabulary_ = []
+            self._block_codes = {}
+
+        codes = np.empty(len(vocabulary), dtype=np.int32)
+
+        for i, name in enumerate(vocabulary):
+            if name not in self._block_codes:
+                if not fitting:
+                    codes[i] = -1
+                    continue
+                self._block_codes[name] = len(self.block_vocabulary_)
+                self.block_vocabulary_.append(name)
+            codes[i] = self._block_codes[name]
+
+        return codes[ids]
+
+    def _blocks(self, X, y, index):
         """Chop the training data into smaller chunks.
 
         A chunk is demarcated by the corresponding block. Each chunk contains
@@ -170,76 +712,229 @@ class BlockClustering(BaseEstimator, ClusterMixin):
         Returns
         -------
         :returns: generator
-            Quadruples in the form of ``(block, X, y, clusterer)`` where
-            X and y are the training examples for given block and clusterer is
-            an object with a ``fit`` method.
+            Triples in the form of ``(block, X, y)`` where X and y are the
+            training examples for given block.
         """
-        unique_blocks = np.unique(blocks)
-
-        for b in unique_blocks:
-            mask = (blocks == b)
-            X_mask = X[mask, :]
+        for i in self._schedule(index):
+            b = index.keys[i]
+            samples = index.samples(i)
+            if self.affinity == "precomputed":
+                X_mask = X[np.ix_(samples, samples)]
+            else:
+                X_mask = X[samples]
             if y is not None:
-                y_mask = y[mask]
+                y_mask = y[samples]
             else:
                 y_mask = None
-            if self.affinity == "precomputed":
-                X_mask = X_mask[:, mask]
 
             yield (b, X_mask, y_mask)
 
-    def _fit(self, X, y, blocks):
-        """Fit base clustering estimators on X."""
-        self.blocks_ = blocks
+    def _schedule(self, index):
+        """Get the positions of the blocks, in the order of computation.
+
+        When fitting from scratch, the blocks restored from a checkpoint are
+        left out.
+        """
+        if self.schedule == "largest_first":
+            # The cost of the pairwise affinity is estimated by N_b^2
+            costs = index.sizes.astype(np.float) ** 2
+            order = np.argsort(-costs, kind="mergesort")
+        else:
+            order = np.arange(len(index))
+
+        if getattr(self, "fit_", False) and self.clusterers_:
+            order = [i for i in order
+                     if index.keys[i] not in self.clusterers_]
 
-        processes = []
-        # Here the blocks will be passed to subprocesses
-        data_queue = SimpleQueue()
-        # Here the results will be passed back
-        result_queue = SimpleQueue()
-        for x in range(self.n_jobs):
-            processes.append(mp.Process(target=_parallel_fit, args=(self.fit_,
-                             self.partial_fit_, self.base_estimator,
-                             self.verbose, data_queue, result_queue)))
-            processes[-1].start()
-
-        # First n_jobs blocks are sent into the queue without waiting for the
-        # results. This variable is a counter that takes care of this.
-        presend = 0
-        blocks_computed = 0
-        blocks_all = len(np.unique(blocks))
-
-        for block in self._blocks(X, y, blocks):
-            if presend >= self.n_jobs:
-                b, clusterer = result_queue.get()
-                blocks_computed += 1
-                if clusterer:
+        return order
+
+    def _restore(self, index):
+        """Load the clusterers of the blocks of ``index`` from checkpoint."""
+        if self.checkpoint is None or not os.path.isdir(self.checkpoint):
+            return
+
+        sizes = dict(zip(index.keys, index.sizes))
+
+        for filename in sorted(os.listdir(self.checkpoint)):
+            if not filename.endswith(".pkl"):
+                continue
+
+            with open(os.path.join(self.checkpoint, filename), "rb") as f:
+                saved = pickle.load(f)
+
+            for b, (n_samples, clusterer) in saved.items():
+                if sizes.get(b) == n_samples:
                     self.clusterers_[b] = clusterer
-            else:
-                presend += 1
+
+    def _save(self, clusterers):
+        """Write a checkpoint of ``clusterers``.
+
+        Every checkpoint is a new file, renamed once written, so that an
+        interrupted write doesn't corrupt the previous checkpoints.
+        """
+        if not os.path.isdir(self.checkpoint):
+            os.makedirs(self.checkpoint)
+
+        fd, path = tempfile.mkstemp(prefix="clusterers-", suffix=".tmp",
+                                    dir=self.checkpoint)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(clusterers, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.rename(path, path[:-len(".tmp")] + ".pkl")
+
+    def _pool(self):
+        """Get the pool of workers for the current call.
+
+        Returns
+        -------
+        :returns: tuple
+            The pool and a boolean telling whether it has to be closed at the
+            end of the call.
+        """
+        if isinstance(self.pool, WorkerPool):
+            return self.pool.start(), False
+
+        elif self.pool == "persistent":
+            pool = getattr(self, "_persistent_pool", None)
+
+            if (pool is None or pool.n_jobs != self.n_jobs or
+                    pool.backend != self.backend):
+                if pool is not None:
+                    pool.close()
+                pool = WorkerPool(n_jobs=self.n_jobs, backend=self.backend)
+                self._persistent_pool = pool
+
+            return pool.start(), False
+
+        elif self.pool is None:
+            pool = WorkerPool(n_jobs=self.n_jobs, backend=self.backend)
+            return pool.start(), True
+
+        else:
+            raise ValueError("Invalid value for pool. Allowed values are "
+                             "None, 'persistent' or a WorkerPool.")
+
+    def _tasks(self, blocks, return_labels=False):
+        """Create the tasks to send to the workers, one for each block.
+
+        Parameters
+        ----------
+        :param blocks: iterable
+            Triples in the form of ``(block, X, y)``.
+
+        :param return_labels: boolean
+            Whether the workers should send back only the labels.
+
+        Returns
+        -------
+        :returns: generator
+            The tasks.
+        """
+        for b, X_mask, y_mask in blocks:
+            clusterer = None
             if self.partial_fit_:
-                if block[0] in self.clusterers_:
-                    data_queue.put(('middle', block, self.clusterers_[b]))
+                clusterer = self.clusterers_.get(b)
+
+            yield _Task(block=b, X=X_mask, y=y_mask,
+                        estimator=self.base_estimator, clusterer=clusterer,
+                        fit=self.fit_, partial_fit=self.partial_fit_,
+                        verbose=self.verbose, return_labels=return_labels,
+                        sent=None)
+
+    def _run(self, blocks, tasks):
+        """Send the tasks to the workers and collect the clusterers."""
+        self.blocks_ = blocks
+        self.block_fit_times_ = {}
+        self.failed_blocks_ = {}
+        self._labels = None
+
+        events = []
+        unsaved = {}
+        blocks_all = len(self._block_index)
+        start_time = time.time()
+        pool, close_pool = self._pool()
+
+        try:
+            for b, clusterer, info in pool.imap_unordered(tasks):
+                events.append(info)
+
+                if self.callback is not None:
+                    self.callback(info)
+
+                if info["error"] is not None:
+                    if self.on_error == "raise":
+                        raise RuntimeError("Fitting block %r failed:\n%s" %
+                                           (b, info["error"]))
+
+                    self.failed_blocks_[b] = info["error"]
+                    self.clusterers_.pop(b, None)
                     continue
 
-            data_queue.put(('middle', block, None))
+                self.clusterers_[b] = clusterer
+                self.block_fit_times_[b] = info["fit_time"]
 
-        # Get the last results and tell the subprocesses to finish
-        for x in range(self.n_jobs):
-            if blocks_computed < blocks_all:
-                print("%s blocks computed out of %s" % (blocks_computed,
-                                                        blocks_all))
-                b, clusterer = result_queue.get()
-                blocks_computed += 1
-                if clusterer:
-                    self.clusterers_[b] = clusterer
+                if self.checkpoint is not None:
+                    unsaved[b] = (info["n_samples"], clusterer)
+                    if len(unsaved) >= self.checkpoint_every:
+                        self._save(unsaved)
+                        unsaved = {}
+
+                if self.verbose > 0:
+                    print("%s blocks computed out of %s" % (len(events),
+                                                            blocks_all))
 
-        data_queue.put(('end', None, None))
+        finally:
+            if close_pool:
+                pool.close()
 
-        time.sleep(1)
+            # Keep the blocks fitted so far, even if the fitting failed
+            if unsaved:
+                self._save(unsaved)
+
+        self.fit_time_ = time.time() - start_time
+        self.fit_summary_ = FitSummary(events, self.fit_time_)
+
+    def _fit(self, X, y, blocks):
+        """Fit base clustering estimators on X."""
+        self._block_index = index = _BlockIndex(blocks)
+
+        if self.fit_:
+            self._restore(index)
+
+        if self.transport == "shared":
+            shared = _SharedBlocks(X, y, index.order, index.offsets,
+                                   square=self.affinity == "precomputed")
+            try:
+                self._run(blocks, self._tasks(
+                    ((index.keys[i],) + shared.block(i)
+                     for i in self._schedule(index)), return_labels=True))
+            finally:
+                shared.close()
+
+        else:
+            self._run(blocks, self._tasks(self._blocks(X, y, index)))
 
         return self
 
+    def close(self):
+        """Shut down the workers kept alive when pool="persistent"."""
+        pool = getattr(self, "_persistent_pool", None)
+
+        if pool is not None:
+            pool.close()
+            del self._persistent_pool
+
+    def __getstate__(self):
+        """Get the state of the estimator, without the persistent pool."""
+        try:
+            state = super(BlockClustering, self).__getstate__()
+        except AttributeError:
+            state = self.__dict__
+
+        state = dict(state)
+        state.pop("_persistent_pool", None)
+        return state
+
     def fit(self, X, y=None, blocks=None):
         """Fit individual base clustering estimators for each block.
 
@@ -262,6 +957,7 @@ class BlockClustering(BaseEstimator, ClusterMixin):
         :returns: self
         """
         # Validate parameters
+        self.block_vocabulary_ = None
         X, blocks = self._validate(X, blocks)
 
         # Reset attributes
@@ -297,6 +993,10 @@ class BlockClustering(BaseEstimator, ClusterMixin):
         # Validate parameters
         X, blocks = self._validate(X, blocks)
 
+        if self.transport == "shared":
+            raise ValueError("partial_fit is not available with "
+                             "transport='shared'.")
+
         # Set attributes if first call
         if not hasattr(self, "clusterers_"):
             self.clusterers_ = {}
@@ -305,6 +1005,120 @@ class BlockClustering(BaseEstimator, ClusterMixin):
 
         return self._fit(X, y, blocks)
 
+    def fit_stream(self, chunks, directory=None):
+        """Fit individual base clustering estimators on a stream of samples.
+
+        The samples of the chunks are written to disk, grouped by block. The
+        blocks are then read back and fitted one by one. Only the block keys
+        of all the samples are kept in memory, hence the peak memory is
+        bounded by the largest blocks being fitted rather than by the whole
+        data.
+
+        With a blocking function depending on the whole data, such as
+        ``block_phonetic`` whose blocks are split above a threshold, every
+        chunk cannot be blocked on its own. The chunks are then written to
+        disk as they come, only the author names of the samples are kept in
+        memory, and all the samples are blocked at once from their names at
+        the end of the stream, as `fit` would. This is done for
+        ``block_phonetic`` and ``block_last_name_first_initial``, possibly
+        given with their parameters in a functools.partial. Other callables
+        are not supported.
+
+        Parameters
+        ----------
+        :param chunks: iterable
+            Chunks of samples. Every chunk is either an array X, a pair
+            ``(X, y)`` or a triple ``(X, y, blocks)``, with the same meaning
+            as the arguments of `fit`.
+
+        :param directory: string or None
+            Where to write the blocks. If None, the default location for
+            temporary files is used.
+
+        Returns
+        -------
+        :returns: self
+        """
+        if self.affinity == "precomputed":
+            raise ValueError("fit_stream is not available with "
+                             "affinity='precomputed'.")
+        if self.transport == "shared":
+            raise ValueError("fit_stream is not available with "
+                             "transport='shared'.")
+
+        by_name = _blocks_names(self.blocking)
+
+        if callable(self.blocking) and not by_name:
+            raise ValueError("fit_stream requires blocking='single', "
+                             "'precomputed', block_phonetic or "
+                             "block_last_name_first_initial, since other "
+                             "blocking functions would block every chunk "
+                             "on its own.")
+
+        spilled = _SpilledBlocks(directory)
+        self.block_vocabulary_ = None
+
+        try:
+            blocks = []
+            name_ids = {}
+
+            for chunk in chunks:
+                if not isinstance(chunk, tuple):
+                    chunk = (chunk, )
+                X, y, blocks_chunk = (chunk + (None, None))[:3]
+
+                if y is not None:
+                    y = np.asarray(y)
+
+                if by_name:
+                    # Every distinct name is kept once, with the index of
+                    # the name of every sample
+                    X = np.asarray(X)
+                    spilled.hold(X, y)
+                    blocks.append(np.array(
+                        [name_ids.setdefault(s["author_name"], len(name_ids))
+                         for s in X[:, 0]], dtype=np.int32))
+                    continue
+
+                X, blocks_chunk = self._validate(X, blocks_chunk)
+                spilled.add(X, y, blocks_chunk)
+                blocks.append(blocks_chunk)
+
+            if len(blocks) == 0:
+                raise ValueError("The stream doesn't contain any sample.")
+
+            blocks = np.concatenate(blocks)
+
+            if by_name:
+                signatures = np.empty(len(name_ids), dtype=np.object)
+                for name, i in name_ids.items():
+                    signatures[i] = {"author_name": name}
+                names = np.empty((len(blocks), 1), dtype=np.object)
+                names[:, 0] = signatures[blocks]
+
+                _, blocks = self._validate(names, None)
+                del names, signatures, name_ids
+
+                start = 0
+                for X, y in spilled.held():
+                    spilled.add(X, y, blocks[start:start + len(X)])
+                    start += len(X)
+
+            # Reset attributes
+            self.clusterers_ = {}
+            self.fit_, self.partial_fit_ = True, False
+
+            self._block_index = index = _BlockIndex(blocks)
+            self._restore(index)
+            self._run(blocks, self._tasks(
+                ((index.keys[i],) + spilled.load(index.keys[i])
+                 for i in self._schedule(index))))
+
+        finally:
+            spilled.close()
+
+        return self
+
     def predict(self, X, blocks=None):
         """Predict data.
 
@@ -322,41 +1136,104 @@ class BlockClustering(BaseEstimator, ClusterMixin):
             The labels.
         """
         # Validate parameters
-        X, blocks = self._validate(X, blocks)
+        X, blocks = self._validate(X, blocks, fitting=False)
 
         # Predict
         labels = -np.ones(len(X), dtype=np.int)
-        offset = 0
+        offsets, n_labels = self._label_offsets()
+        index = _BlockIndex(blocks)
+
+        if index.overlapping:
+            raise ValueError("predict is not available with overlapping "
+                             "blocks.")
 
-        for b in np.unique(blocks):
+        for i, b in enumerate(index.keys):
             # Predict on the block, if known
             if b in self.clusterers_:
-                mask = (blocks == b)
+                samples = index.samples(i)
                 clusterer = self.clusterers_[b]
 
-                pred = np.array(clusterer.predict(X[mask]))
-                pred[(pred != -1)] += offset
-                labels[mask] = pred
-                offset += np.max(clusterer.labels_) + 1
+                pred = np.array(clusterer.predict(X[samples]))
+
+                # The clusterer may create new clusters for unseen samples,
+                # which get labels above all the labels of the fit
+                new = pred > np.max(clusterer.labels_)
+                pred[(pred != -1) & ~new] += offsets[b]
+                if np.any(new):
+                    new_labels, pred[new] = np.unique(pred[new],
+                                                      return_inverse=True)
+                    pred[new] += n_labels
+                    n_labels += len(new_labels)
+
+                labels[samples] = pred
 
         return labels
 
+    def _label_offsets(self):
+        """Get the offsets of the labels of the blocks in `labels_`.
+
+        Blocks fitted by a previous call to `partial_fit`, absent from the
+        last batch, are not part of `labels_`. Their labels come after.
+
+        Returns
+        -------
+        :returns: tuple
+            The dictionary of the offsets of the labels of every block, and
+            the total number of labels.
+        """
+        keys = [b for b in self._block_index.keys if b in self.clusterers_]
+        keys.extend(sorted(set(self.clusterers_).difference(keys)))
+        offsets = {}
+        offset = 0
+
+        for b in keys:
+            offsets[b] = offset
+            offset += np.max(self.clusterers_[b].labels_) + 1
+
+        return offsets, offset
+
+    def clear_labels_cache(self):
+        """Clear the cached labels.
+
+        This must be called when the clusterers in `clusterers_` are
+        modified in place, e.g. by changing their parameters, for `labels_`
+        to reflect the modification.
+        """
+        self._labels = None
+
     @property
     def labels_(self):
         """Compute the labels assigned to the input data.
 
-        Note that labels are computed on-the-fly.
+        Note that labels are computed on the first access only. The cached
+        array is returned afterwards.
         """
+        if getattr(self, "_labels", None) is not None:
+            return self._labels
+
         labels = -np.ones(len(self.blocks_), dtype=np.int)
-        offset = 0
+        offsets, n_labels = self._label_offsets()
+        index = self._block_index
+        assignments = []
+
+        # Blocks fitted by a previous call to partial_fit, absent from the
+        # last batch, are not part of the index
+        for i, b in enumerate(index.keys):
+            if b not in self.clusterers_:
+                continue
 
-        for b in self.clusterers_:
-            mask = (self.blocks_ == b)
             clusterer = self.clusterers_[b]
 
             pred = np.array(clusterer.labels_)
-            pred[(pred != -1)] += offset
-            labels[mask] = pred
-            offset += np.max(clusterer.labels_) + 1
+            pred[(pred != -1)] += offsets[b]
+            if index.overlapping:
+                assignments.append((index.samples(i), pred))
+            else:
+                labels[index.samples(i)] = pred
+
+        if index.overlapping:
+            labels = _reconcile(len(labels), assignments, n_labels)
+
+        self._labels = labels
 
         return labels
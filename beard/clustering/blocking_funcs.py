@@ -13,174 +13,772 @@
 
 """
 
+from collections import OrderedDict
+import functools
+import multiprocessing as mp
 import numpy as np
 import six
 
+from six.moves import cPickle as pickle
+
 from beard.utils import normalize_name
-from beard.utils.names import phonetic_tokenize_name
+from beard.utils.names import phonetic_tokenize_names
 from beard.utils.names import given_name_initial
 
 
-class _Block:
+class _GivenNames(object):
+
+    """Given names of the signatures with a single surname in a block.
 
-    """Representation of a block.
+    Only the existence of the given names matters for matching surnames
+    against them, hence they are kept as sets of tuples of tokens: the given
+    names themselves and all their proper suffixes.
+    """
 
-    Block stores information about different variation of names and the
-    quantities of their appearances on the papers.
+    __slots__ = ("names", "suffixes")
 
-    Example of a block _content:
+    def __init__(self, given_names):
+        """Index the given names.
 
-    .. code:: python
+        Parameters
+        ----------
+        :param given_names: iterable
+            Tuples of tokens representing given names on the signatures.
+        """
+        self.names = set(given_names)
+        self.suffixes = set(names[-length:] for names in self.names
+                            for length in range(1, len(names)))
+
+    def matches_from_last(self, first_surnames):
+        """Check if the first surnames match the last given names.
+
+        For example, ``Sanchez-Gomez, Juan`` can appear on a signature as
+        ``Gomez, Juan Sanchez``. This function checks if there is a match
+        between surnames like ``Sanchez`` and the given names in the block.
+        In this case, a signature like ``Gomez, J. Sanchez`` will create a
+        match, while ``Gomez, Juan S.`` won't.
+
+        Full names have to match: either the last given names of a signature
+        are all the first surnames, or all the given names of a signature
+        are the last of the first surnames.
+
+        Parameters
+        ----------
+        :param first_surnames: tuple
+            Tokens which represent few first surnames.
+
+        Returns
+        -------
+        :returns: boolean
+            Information whether the block contains this author if some of
+            the first surnames are treated as the last given names.
+        """
+        return (first_surnames in self.suffixes or
+                any(first_surnames[start:] in self.names
+                    for start in range(len(first_surnames) + 1)))
+
+
+class _TokenInterner(object):
+
+    """Mapping of token tuples to integer ids."""
+
+    __slots__ = ("ids", "tokens")
 
-        {
-            ('JNS',): {
-                ('P',): 2, ('P', 'PL'): 3, ('P', 'JH'): 2
-            },
-            ('JNS', 'SM0'): {
-                ('PAL', 'JH'): 5, ('JH',): 3, ('SMN',): 2
-            },
-            ('RCN', 'JNS'): {
-                ('A',): 34
-            }
-        }
-
-    From the example above, one can see that the block stores information
-    about 5 signatures of 'JNS' 'SM0', 'PAL' 'JH'. Those strings are results
-    of the phonetic algorithm. Such signature might correspond, for
-    example, to Jones-Smith, Paul John.
+    def __init__(self):
+        """Create an empty mapping."""
+        self.ids = {}
+        self.tokens = []
+
+    def __call__(self, tokens):
+        """Get the id of ``tokens``, assigning a new one if necessary."""
+        try:
+            return self.ids[tokens]
+        except KeyError:
+            self.ids[tokens] = len(self.tokens)
+            self.tokens.append(tokens)
+            return self.ids[tokens]
+
+
+class _BlockTable(object):
+
+    """Content of all the blocks of integer coded tokens, in sorted arrays.
+
+    The table holds the number of signatures of every combination of
+    surnames and given names in every block. Each combination is a row of
+    four arrays, sorted by block, surnames and given names: the code of the
+    block, the tuples of surname and of given name tokens packed into 64-bit
+    integers, and the count. This takes 24 bytes per distinct combination,
+    several times less than nested dictionaries of tuples.
+
+    Up to three tokens with codes below 2^21 - 1 are packed into an integer.
+    Longer tuples, which are rare, are stored once in an interner and
+    referred to by negative integers.
+
+    The arrays are searched for many keys at once, hence the table is meant
+    to be updated and queried in batches, as ``BlockingIndex`` does.
     """
 
-    def __init__(self, surnames, given_names):
-        """Create a block. Add given names from the first signature.
+    _BITS = 21
+
+    # Key of the tuples of tokens which are not in the table
+    _MISSING = np.iinfo(np.int64).min
+
+    def __init__(self):
+        """Create an empty table."""
+        self._blocks = np.zeros(0, dtype=np.int32)
+        self._surnames = np.zeros(0, dtype=np.int64)
+        self._given_names = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int32)
+        self._interner = _TokenInterner()
+
+    def _pack(self, tokens, add=True):
+        """Get the integer representing a tuple of token codes.
+
+        If ``add`` is False, tuples which need to be interned and are not
+        yet give ``_MISSING``.
+        """
+        if len(tokens) <= 3:
+            key = 0
+            for i, token in enumerate(tokens):
+                if token + 1 >= 1 << self._BITS:
+                    break
+                key |= (token + 1) << (self._BITS * i)
+            else:
+                return key
+
+        if not add and tokens not in self._interner.ids:
+            return self._MISSING
+
+        return -1 - self._interner(tokens)
+
+    def _unpack(self, key):
+        """Get the tuple of token codes represented by an integer."""
+        key = int(key)
+        if key < 0:
+            return self._interner.tokens[-1 - key]
+
+        mask = (1 << self._BITS) - 1
+        tokens = []
+        while key:
+            tokens.append((key & mask) - 1)
+            key >>= self._BITS
+        return tuple(tokens)
+
+    def _rows(self, block, surnames):
+        """Get the range of the rows of the surnames of a block."""
+        lo, hi = np.searchsorted(self._blocks, (block, block + 1))
+        lo, hi = lo + np.searchsorted(self._surnames[lo:hi],
+                                      (surnames, surnames + 1))
+        return lo, hi
+
+    def _merge(self, blocks, surnames, given_names, counts):
+        """Merge rows into the sorted arrays, adding up repeated rows."""
+        if len(blocks) == 0:
+            return
+
+        blocks = np.concatenate((self._blocks, blocks))
+        surnames = np.concatenate((self._surnames, surnames))
+        given_names = np.concatenate((self._given_names, given_names))
+        counts = np.concatenate((self._counts, counts))
+
+        order = np.lexsort((given_names, surnames, blocks))
+        blocks, surnames = blocks[order], surnames[order]
+        given_names, counts = given_names[order], counts[order]
+
+        starts = np.flatnonzero(np.concatenate((
+            [True],
+            (blocks[1:] != blocks[:-1]) |
+            (surnames[1:] != surnames[:-1]) |
+            (given_names[1:] != given_names[:-1]))))
+
+        self._blocks = blocks[starts]
+        self._surnames = surnames[starts]
+        self._given_names = given_names[starts]
+        self._counts = np.add.reduceat(counts, starts).astype(np.int32)
+
+    def add(self, blocks, surnames, given_names, counts):
+        """Add signatures to blocks.
+
+        Parameters
+        ----------
+        :param blocks: list
+            The code of the block of every combination.
+        :param surnames: list
+            The tuple of surname tokens of every combination.
+        :param given_names: list
+            The tuple of given name tokens of every combination.
+        :param counts: list
+            The number of signatures of every combination.
+        """
+        self._merge(np.array(blocks, dtype=np.int32),
+                    np.array([self._pack(tokens) for tokens in surnames],
+                             dtype=np.int64),
+                    np.array([self._pack(tokens) for tokens in given_names],
+                             dtype=np.int64),
+                    np.array(counts, dtype=np.int32))
+
+    def has_blocks(self, blocks):
+        """Check which blocks contain at least one signature.
 
         Parameters
         ----------
-        :param surnames: tuple
-            Strings representing surnames on a signature.
-        :param given_names: tuple
-            Strings representing given names on a signature.
+        :param blocks: list
+            Codes of blocks.
+
+        Returns
+        -------
+        :returns: numpy array
+            Boolean array, True for the blocks in the table.
+        """
+        blocks = np.array(blocks, dtype=np.int32)
+        positions = np.searchsorted(self._blocks, blocks)
+        found = positions < len(self._blocks)
+        found[found] = self._blocks[positions[found]] == blocks[found]
+        return found
+
+    def contains(self, blocks, surnames):
+        """Check which blocks have at least one signature with surnames.
+
+        Parameters
+        ----------
+        :param blocks: list
+            Codes of blocks.
+        :param surnames: list
+            The tuple of surname tokens to look for in every block.
+
+        Returns
+        -------
+        :returns: numpy array
+            Boolean array, True if the block contains the surnames.
         """
-        self._content = {surnames: {given_names: 1}}
+        if len(blocks) == 0:
+            return np.zeros(0, dtype=bool)
+
+        n_rows = len(self._blocks)
+        keys = np.array([self._pack(tokens, add=False) for tokens in surnames],
+                        dtype=np.int64)
 
-        self._name = surnames[-1]
+        # Rank the packed surnames, so that rows and queries are sorted by
+        # a single integer combining the block and the surnames
+        ranks = np.unique(np.concatenate((self._surnames, keys)),
+                          return_inverse=True)[1].astype(np.int64)
+        n_ranks = ranks.max() + 1
+        rows = self._blocks * n_ranks + ranks[:n_rows]
+        queries = np.array(blocks, dtype=np.int64) * n_ranks + ranks[n_rows:]
 
-    def add_signature(self, surnames, given_names):
-        """Add a signature to the block.
+        positions = np.searchsorted(rows, queries)
+        found = positions < n_rows
+        found[found] = rows[positions[found]] == queries[found]
+        return found
+
+    def given_names(self, block, surnames):
+        """Get the given names of the signatures with surnames in a block.
 
         Parameters
         ----------
+        :param block: integer
+            Code of the block.
         :param surnames: tuple
-            Strings representing surnames on a signature.
-        :param given_names: tuple
-            Strings representing given_names on a signature.
+            Tokens of the surnames.
+
+        Returns
+        -------
+        :returns: list
+            The tuples of given name tokens.
         """
-        if surnames in self._content:
-            if given_names in self._content[surnames]:
-                self._content[surnames][given_names] += 1
-            else:
-                self._content[surnames][given_names] = 1
-        else:
-            self._content[surnames] = {given_names: 1}
+        lo, hi = self._rows(block, self._pack(surnames, add=False))
+        return [self._unpack(key) for key in self._given_names[lo:hi]]
 
-    def compare_tokens_from_last(self, first_surnames, last_surname):
-        """Check if a part of the surname matches with given names in block.
+    def count(self, block, surnames, given_names):
+        """Get the number of signatures of a combination in a block."""
+        lo, hi = self._rows(block, self._pack(surnames, add=False))
+        given_names = self._pack(given_names, add=False)
+        i = lo + np.searchsorted(self._given_names[lo:hi], given_names)
 
-        For example, ``Sanchez-Gomez, Juan`` can appear on a signature as
-        ``Gomez, Juan Sanchez``. This function checks if there is a match
-        between surnames like ``Sanchez`` and the given names in the block.
-        In this case, a signature like ``Gomez, J. Sanchez`` will create a
-        match, while ``Gomez, Juan S.`` won't.
+        if i < hi and self._given_names[i] == given_names:
+            return int(self._counts[i])
+
+        return 0
+
+
+def _last_name_first_initial(name):
+    """Get the normalized last name and first initial of a name."""
+    names = normalize_name(name).split(" ", 1)
+
+    try:
+        name = "%s %s" % (names[0], names[1].strip()[0])
+    except IndexError:
+        name = names[0]
+
+    return name
+
+
+def _map_chunks(func, items, n_jobs=1, **kwargs):
+    """Apply ``func`` to consecutive chunks of ``items``.
+
+    Parameters
+    ----------
+    :param func: callable
+        Function of a list of items, with the keyword arguments ``kwargs``.
+        It must be picklable when ``n_jobs`` is not 1.
+    :param items: list
+        Items to split into chunks.
+    :param n_jobs: integer
+        Number of processes to use. If negative, ``cpu_count() + 1 + n_jobs``
+        processes are used.
+
+    Returns
+    -------
+    :returns: list
+        The results of ``func`` on every chunk, in the order of the chunks.
+    """
+    if n_jobs < 0:
+        n_jobs = max(mp.cpu_count() + 1 + n_jobs, 1)
 
-        Full names have to match. Only the signatures with single surname
-        are used for matching.
+    func = functools.partial(func, **kwargs)
+
+    if n_jobs == 1 or len(items) <= 1:
+        return [func(items)]
+
+    chunk_size = -(-len(items) // n_jobs)
+    chunks = [items[i:i + chunk_size]
+              for i in range(0, len(items), chunk_size)]
+
+    pool = mp.Pool(min(n_jobs, len(chunks)))
+    try:
+        return pool.map(func, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _unique_names(X):
+    """Get the distinct names of the signatures in ``X``.
+
+    Returns
+    -------
+    :returns: tuple
+        The list of the names of the signatures, the list of the distinct
+        names, and the index of every name among the distinct ones.
+    """
+    names = [signature['author_name'] for signature in X[:, 0]]
+    name_ids = {}
+    inverse = [name_ids.setdefault(name, len(name_ids)) for name in names]
+
+    unique_names = [None] * len(name_ids)
+    for name, i in six.iteritems(name_ids):
+        unique_names[i] = name
+
+    return names, unique_names, inverse
+
+
+def _tokenize_chunk(names, phonetic_algorithm="double_metaphone"):
+    """Tokenize distinct names, for blocking them in another process."""
+    _, tokens, vocabulary = phonetic_tokenize_names(
+        names, phonetic_algorithm=phonetic_algorithm)
+    return tokens, vocabulary
+
+
+def _last_name_first_initial_chunk(names):
+    """Get the last name and first initial of every name of a chunk."""
+    return [_last_name_first_initial(name) for name in names]
+
+
+class BlockingIndex(object):
+
+    """Persistent index of the blocks of signatures, updated incrementally.
+
+    The index keeps the phonetic blocks, the names and the block sizes of
+    all the signatures added so far. New signatures are assigned to blocks
+    as ``block_phonetic`` would, given the signatures already in the index,
+    and the index reports which blocks changed, so that only those need to
+    be clustered again. Signatures already in the index keep their phonetic
+    block, but may move to a more refined block if their block grows above
+    ``threshold``.
+
+    The index can be saved to disk with `save` and loaded back with `load`
+    between runs.
+
+    Example
+    -------
+    .. code:: python
+
+        index = BlockingIndex.load("blocks.pkl")
+        blocks, changed = index.add(X_new)
+        index.save("blocks.pkl")
+    """
+
+    def __init__(self, blocking="phonetic", threshold=1000,
+                 phonetic_algorithm="double_metaphone", max_splits=1,
+                 n_jobs=1):
+        """Create an empty index.
 
         Parameters
         ----------
-        :param first_surnames: tuple
-            Tokens which represent  few first surnames. In form of a tuple of
-            strings.
-        :param last_surname: tuple
-            Tokens, usually one, representing last surname(s) of the author.
+        :param blocking: string, default "phonetic"
+            The blocking strategy.
+            - "phonetic": as ``block_phonetic``;
+            - "last_name_first_initial": as
+              ``block_last_name_first_initial``.
+        :param threshold: integer
+            Size above which the phonetic blocks are split into smaller ones.
+        :param phonetic algorithm: string
+            Which phonetic algorithm will be used. See ``block_phonetic``.
+        :param max_splits: integer or None
+            Maximum number of times a phonetic block is split. See
+            ``block_phonetic``.
+        :param n_jobs: integer
+            Number of processes normalizing and tokenizing the names. The
+            blocks don't depend on it.
+        """
+        if blocking not in ("phonetic", "last_name_first_initial"):
+            raise ValueError("Invalid value for blocking. Allowed values are "
+                             "'phonetic' or 'last_name_first_initial'.")
+
+        self.blocking = blocking
+        self.threshold = threshold
+        self.phonetic_algorithm = phonetic_algorithm
+        self.max_splits = max_splits
+        self.n_jobs = n_jobs
+
+        # Phonetic tokens, indexed by their integer code
+        self._vocabulary = []
+        self._token_ids = {}
+
+        # Content of the phonetic blocks, identified by the code of their
+        # surname token
+        self._table = _BlockTable()
+
+        # Block of every name, the phonetic one if blocking="phonetic"
+        self._names = {}
+
+        # Names in every phonetic block
+        self._block_names = {}
+
+        # Number of signatures for every pair (depth of the split, block id)
+        self._sizes = {}
+
+    def add(self, X):
+        """Add signatures to the index.
+
+        Parameters
+        ----------
+        :param X: numpy array
+            Array of one element arrays of dictionaries. Each dictionary
+            represents a signature and needs the ``author_name`` field.
+
+        Returns
+        -------
+        :returns: tuple
+            The array of the block ids of the signatures in ``X`` and the set
+            of the ids of the blocks which changed, i.e. which gained new
+            signatures or whose signatures moved to another block.
+        """
+        names, unique_names, inverse = _unique_names(X)
+
+        if self.blocking == "last_name_first_initial":
+            new_names = [name for name in unique_names
+                         if name not in self._names]
+            results = _map_chunks(_last_name_first_initial_chunk, new_names,
+                                  n_jobs=self.n_jobs)
+            self._names.update(zip(new_names,
+                                   (key for keys in results for key in keys)))
+
+            blocks = [self._names[name] for name in names]
+
+            return np.array(blocks), set(blocks)
+
+        name_tokens = []
+
+        for tokens, vocabulary in _map_chunks(
+                _tokenize_chunk, unique_names, n_jobs=self.n_jobs,
+                phonetic_algorithm=self.phonetic_algorithm):
+            # Use the codes of the index for the tokens
+            codes = []
+            for token in vocabulary:
+                if token not in self._token_ids:
+                    self._token_ids[token] = len(self._vocabulary)
+                    self._vocabulary.append(token)
+                codes.append(self._token_ids[token])
+
+            name_tokens.extend(tuple(tuple(codes[t] for t in words)
+                                     for words in name) for name in tokens)
+
+        phonetic_blocks = self._assign(name_tokens, inverse)
+
+        # Blocks of the names already in the index, before the update
+        previous = {}
+        for block in set(phonetic_blocks):
+            for name in self._block_names.get(block, ()):
+                previous[(block, name)] = self._block_id(block, name)
+
+        # Number of signatures of every distinct pair (block, name), in the
+        # order of their first signature
+        pairs = OrderedDict()
+        for pair in zip(phonetic_blocks, inverse):
+            pairs[pair] = pairs.get(pair, 0) + 1
+
+        for (block, name), count in six.iteritems(pairs):
+            name = unique_names[name]
+            self._names.setdefault(name, block)
+            self._block_names.setdefault(block, set()).add(name)
+
+            for key in self._path(block, name):
+                self._sizes[key] = self._sizes.get(key, 0) + count
+
+        block_ids = dict((pair, self._block_id(pair[0], unique_names[pair[1]]))
+                         for pair in pairs)
+        blocks = [block_ids[pair] for pair in zip(phonetic_blocks, inverse)]
+
+        changed = set(blocks)
+
+        for (block, name), block_id in previous.items():
+            new_block_id = self._block_id(block, name)
+            if new_block_id != block_id:
+                changed.update((block_id, new_block_id))
+
+        return np.array(blocks), changed
+
+    def transform(self, X):
+        """Get the current block ids of signatures already in the index.
+
+        Parameters
+        ----------
+        :param X: numpy array
+            Array of one element arrays of dictionaries, with the
+            ``author_name`` field.
 
         Raises
         ------
         :raises: KeyError
-            When the last name is not included in the cluster
+            When the name of a signature is not in the index.
 
         Returns
         -------
-        :returns: boolean
-            Information whether cluster contains this author if some of the
-            first last names are treated as the last given names.
+        :returns: numpy array
+            Array with the ids of the blocks.
+        """
+        names = [signature['author_name'] for signature in X[:, 0]]
+
+        if self.blocking == "last_name_first_initial":
+            return np.array([self._names[name] for name in names])
+
+        return np.array([self._block_id(self._names[name], name)
+                         for name in names])
+
+    def save(self, filename):
+        """Save the index to ``filename``."""
+        with open(filename, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename):
+        """Load an index saved with `save`."""
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+    def _path(self, block, name):
+        """Get the successive ids of a signature when its block is split.
+
+        Returns
+        -------
+        :returns: generator
+            Pairs ``(depth, block id)``, starting from the phonetic block and
+            appending one given name initial at every depth.
         """
-        if last_surname in self._content:
-            for given_names in six.iterkeys(self._content[last_surname]):
-                given_names_left = len(given_names)
-                for reversed_index, name in \
-                        enumerate(reversed(first_surnames)):
-                    if given_names_left == 0:
-                        return True
-                    elif given_names[-(reversed_index + 1)] != name:
-                        break
-                    given_names_left -= 1
-                    if reversed_index == len(first_surnames) - 1:
-                        return True
-            return False
-        self._raise_keyerror(last_surname)
-
-    def contains(self, surnames):
-        """Check if there is at least one signature with given surnames.
+        key = self._vocabulary[block]
+        depth = 0
+
+        while True:
+            yield depth, key
+
+            if self.max_splits is not None and depth >= self.max_splits:
+                return
+
+            initial = given_name_initial(name, depth)
+            if not initial:
+                return
+
+            key += initial
+            depth += 1
+
+    def _block_id(self, block, name):
+        """Get the id of the block of a name, once oversized blocks split."""
+        for depth, key in self._path(block, name):
+            if self._sizes[(depth, key)] <= self.threshold:
+                break
+
+        return key
+
+    def _assign(self, name_tokens, inverse):
+        """Assign the signatures to the phonetic blocks.
 
         Parameters
         ----------
-        :param surnames: tuple
-            Strings representing surnames on a signature.
+        :param name_tokens: list
+            Integer coded tokens of every distinct name, as returned by
+            ``phonetic_tokenize_names``.
+        :param inverse: list
+            Index of the name of every signature in ``name_tokens``.
 
         Returns
         -------
-        :returns: boolean
-            True if there is at least one sinature with given surnames.
+        :returns: list
+            The code of the surname token of the block of every signature.
         """
-        return surnames in self._content
+        # Content of all the blocks. Every block is identified by the token
+        # that was used to create it. It is the last token from the surnames
+        # tokens of its first signature.
+        table = self._table
+        counts = np.bincount(inverse, minlength=len(name_tokens))
+
+        # First phase.
+        # Create blocks for signatures with single surname, at once.
+        # Signatures with multiple surnames are left for the second phase.
+        single = [i for i, tokens in enumerate(name_tokens)
+                  if len(tokens[0]) == 1]
+        table.add([name_tokens[i][0][0] for i in single],
+                  [name_tokens[i][0] for i in single],
+                  [name_tokens[i][1] for i in single],
+                  counts[single])
+
+        blocks = [name_tokens[i][0][0] if len(name_tokens[i][0]) == 1
+                  else None for i in inverse]
+
+        # Second phase.
+        # Assign every signature with multiple surnames to the block of the
+        # first surname or the block of the last surname.
+        multiple = [i for i, tokens in enumerate(name_tokens)
+                    if len(tokens[0]) > 1]
+        multiple_surnames = [name_tokens[i][0] for i in multiple]
+        firsts = [tokens[0] for tokens in multiple_surnames]
+        lasts = [tokens[-1] for tokens in multiple_surnames]
+
+        # Look up the blocks as they are after the first phase at once, and
+        # keep the signatures added during the second phase in dictionaries
+        in_first = dict(zip(multiple,
+                            table.contains(firsts, multiple_surnames)))
+        in_last = dict(zip(multiple,
+                           table.contains(lasts, multiple_surnames)))
+        existing = set(np.array(firsts + lasts, dtype=np.int64)[
+            table.has_blocks(firsts + lasts)].tolist())
+        added = {}
+
+        # Block of the names added during the second phase, which all their
+        # next signatures join, and given names of the single surname blocks
+        assigned = {}
+        given_names = {}
+
+        for i, name in enumerate(inverse):
+
+            if blocks[i] is not None:
+                # There is already a block
+                continue
 
-    def _raise_keyerror(self, key):
-        raise KeyError("The cluster doesn't contain a key %s" % key)
+            surnames, given = name_tokens[name]
+            first, last = surnames[0], surnames[-1]
 
+            if name in assigned:
+                blocks[i] = assigned[name]
 
-def _split_blocks(blocks, X, threshold):
+            # Check if this combination of surnames was already included
+            elif in_first[name] or (first, surnames) in added:
+                blocks[i] = first
+
+            elif in_last[name] or (last, surnames) in added:
+                blocks[i] = last
 
-    splitted_blocks = []
+            else:
+                # No match, compute heuristically the match over initials.
+                # Check if some of the surnames were used as the last given
+                # names on some of the signatures.
+                if last not in given_names:
+                    given_names[last] = _GivenNames(
+                        table.given_names(last, (last,)))
 
-    id_to_size = {}
+                if any(given_names[last].matches_from_last(surnames[:index])
+                       for index in range(len(surnames) - 1, 0, -1)):
+                    blocks[i] = last
 
-    for block in blocks:
-        if block._name in id_to_size:
-            id_to_size[block._name] += 1
-        else:
-            id_to_size[block._name] = 1
+                elif first in existing:
+                    # No match with last surname. Match with the first one.
+                    blocks[i] = first
 
-    for index, block in enumerate(blocks):
-        if id_to_size[block._name] > threshold:
+                else:
+                    # No block for the first surname and no good match for
+                    # the last surname. The signature is added to the block
+                    # of the last surname only if it creates the block.
+                    blocks[i] = last
+                    if last in existing:
+                        continue
 
-            splitted_blocks.append(block._name +
-                                   given_name_initial(X[index
-                                                        ][0]['author_name']))
-        else:
-            splitted_blocks.append(block._name)
+            assigned[name] = blocks[i]
+            existing.add(blocks[i])
 
-    return splitted_blocks
+            content = added.setdefault((blocks[i], surnames), {})
+            content[given] = content.get(given, 0) + 1
 
+        rows = [(block, surnames, given, count)
+                for (block, surnames), content in six.iteritems(added)
+                for given, count in six.iteritems(content)]
+        if rows:
+            table.add(*zip(*rows))
 
-def block_phonetic(X, threshold=1000, phonetic_algorithm="double_metaphone"):
+        return blocks
+
+
+def encode_blocks(blocks):
+    """Encode block ids as dense integers.
+
+    Parameters
+    ----------
+    :param blocks: array-like
+        Block ids, as returned by a blocking function.
+
+    Returns
+    -------
+    :returns: tuple
+        The array of int32 block ids, of the shape of ``blocks``, and the
+        array of the block names they index, in sorted order.
+    """
+    blocks = np.asarray(blocks)
+    vocabulary, ids = np.unique(blocks, return_inverse=True)
+
+    return ids.astype(np.int32).reshape(blocks.shape), vocabulary
+
+
+def block_size_histogram(blocks):
+    """Compute the histogram of the block sizes.
+
+    The cost of clustering a block of N_b samples grows as N_b^2, hence the
+    largest sizes bound the time and the memory of the clustering.
+
+    Parameters
+    ----------
+    :param blocks: array-like, shape (n_samples, )
+        Block ids, as returned by a blocking function.
+
+    Returns
+    -------
+    :returns: tuple of numpy arrays
+        The distinct block sizes, in increasing order, and the number of
+        blocks of every size.
+    """
+    _, sizes = np.unique(np.asarray(blocks), return_counts=True)
+    return np.unique(sizes, return_counts=True)
+
+
+def block_phonetic(X, threshold=1000, phonetic_algorithm="double_metaphone",
+                   max_splits=1, n_jobs=1, return_ids=False):
     """Block the signatures.
 
     This blocking algorithm takes into consideration the cases, where
     author has more than one surname. Such a signature can be assigned
     to a block for the first author surname or the last one.
 
-    The names are preprocessed by ``phonetic_tokenize_name`` function. As a
+    The names are preprocessed by ``phonetic_tokenize_names`` function. As a
     result, here the algorithm operates on ``Double Metaphone`` tokens which
-    are previously normalized.
+    are previously normalized. Every distinct name is tokenized only once.
 
     The algorithm has two phases. In the first phase, all the signatures with
     one surname are clustered together. Every different surname token creates
@@ -198,7 +796,10 @@ def block_phonetic(X, threshold=1000, phonetic_algorithm="double_metaphone"):
     To prevent creation of too big clusters, the ``threshold`` parameter can
     be set. The algorithm will split every block which size is bigger than
     ``threshold`` into smaller ones using given names initials as the
-    condition.
+    condition. With ``max_splits`` greater than one, the blocks still bigger
+    than ``threshold`` are split again using the next given name initial,
+    which bounds the cost of clustering the largest blocks. Use
+    ``block_size_histogram`` to check the sizes of the resulting blocks.
 
     Parameters
     ----------
@@ -213,131 +814,36 @@ def block_phonetic(X, threshold=1000, phonetic_algorithm="double_metaphone"):
         -  "double_metaphone"
         -  "nysiis" (only for Python 2)
         -  "soundex" (only for Python 2)
-
+    :param max_splits: integer or None
+        Maximum number of times a block is split. If None, the blocks are
+        split until they are not bigger than ``threshold`` or their names
+        have no more given name initials.
+    :param n_jobs: integer
+        Number of processes normalizing and tokenizing the names, in chunks.
+        The blocks are then built in the calling process, hence they don't
+        depend on ``n_jobs``.
+    :param return_ids: boolean
+        Whether to return integer block ids with the block names, instead
+        of the names.
 
     Returns
     -------
-    :returns: numpy array
+    :returns: numpy array or tuple
         Array with ids of the blocks. The ids are strings. The order of the
-        array is the same as in the ``X`` input parameter.
+        array is the same as in the ``X`` input parameter. If
+        ``return_ids``, the array of int32 ids and the array of the block
+        names they index, as returned by ``encode_blocks``.
     """
-    # Stores all clusters. It is the only way to access them.
-    # Every cluster can be accessed by the token that was used to create it.
-    # It is the last token from the surnames tokens passed to the constructor.
-    id_to_block = {}
-
-    # List of tuples. Used as the in-between state of the algorithm between
-    # the first and the second states. The tuple contain the block name
-    # if the signature has been already blocked or None otherwise, and the
-    # tokens.
-    ordered_tokens = []
-
-    # First phase.
-    # Create blocks for signatures with single surname
-
-    for signature_array in X[:, 0]:
-        tokens = phonetic_tokenize_name(signature_array['author_name'],
-                                        phonetic_algorithm=phonetic_algorithm)
-        surname_tokens = tokens[0]
-        if len(surname_tokens) == 1:
-            # Single surname case
-            surname = surname_tokens[0]
-            if surname not in id_to_block:
-                id_to_block[surname] = _Block(*tokens)
-            else:
-                id_to_block[surname].add_signature(*tokens)
-            ordered_tokens.append((surname, tokens))
-        else:
-            # Multiple surnames
-            ordered_tokens.append((None, tokens))
-
-    # Second phase.
-    # Assign every signature with multiple surnames to the block of the
-    # first surname or the block of the last surname.
-
-    blocks = []
+    index = BlockingIndex(threshold=threshold,
+                          phonetic_algorithm=phonetic_algorithm,
+                          max_splits=max_splits, n_jobs=n_jobs)
 
-    for token_tuple in ordered_tokens:
+    blocks = index.add(X)[0]
 
-        if token_tuple[0] is not None:
+    if return_ids:
+        return encode_blocks(blocks)
 
-            # There is already a block
-            blocks.append(id_to_block[token_tuple[0]])
-
-        else:
-
-            # Case of multiple surnames
-            tokens = token_tuple[1]
-            surnames, given_names = tokens
-
-            # Check if this combination of surnames was already included
-            try:
-                # First surname
-
-                cluster = id_to_block[surnames[0]]
-                if cluster.contains(surnames):
-                    cluster.add_signature(*tokens)
-                    blocks.append(cluster)
-                    continue
-            except KeyError:
-                # No such block
-                pass
-
-            try:
-                # Last surname
-
-                cluster = id_to_block[surnames[-1]]
-                if cluster.contains(surnames):
-                    cluster.add_signature(*tokens)
-                    blocks.append(cluster)
-                    continue
-
-                # # No match, compute heuristically the match over initials
-
-                # Firstly, check if some of the surnames were used as the
-                # last given names on some of the signatures.
-                index = len(surnames) - 1
-                match_found = False
-
-                while index > 0:
-                    token_prefix = surnames[:index]
-                    if cluster.compare_tokens_from_last(token_prefix,
-                                                        (surnames[-1],)):
-                        cluster.add_signature(*tokens)
-                        match_found = True
-                        break
-                    index -= 1
-
-                if match_found:
-                    # There was a full name match, so it must be the same
-                    # author.
-                    blocks.append(cluster)
-                    continue
-
-            except KeyError:
-                # No such block
-                pass
-
-            try:
-                # No match with last surname. Match with the first one.
-                cluster = id_to_block[surnames[0]]
-                cluster.add_signature(*tokens)
-                blocks.append(cluster)
-
-                continue
-
-            except KeyError:
-                # No such block
-                pass
-
-            # No block for the first surname and no good match for the
-            # last surname.
-            if surnames[-1] not in id_to_block:
-                # Create new block.
-                id_to_block[surnames[-1]] = _Block(*tokens)
-            blocks.append(id_to_block[surnames[-1]])
-
-    return np.array(_split_blocks(blocks, X, threshold))
+    return blocks
 
 
 def block_single(X):
@@ -357,7 +863,7 @@ def block_single(X):
     return np.zeros(len(X), dtype=np.int)
 
 
-def block_last_name_first_initial(X):
+def block_last_name_first_initial(X, n_jobs=1, return_ids=False):
     """Blocking function using last name and first initial as key.
 
     The names are normalized before assigning to a block.
@@ -366,26 +872,74 @@ def block_last_name_first_initial(X):
     ----------
     :param X: numpy array
         Array of singletons of dictionaries.
+    :param n_jobs: integer
+        Number of processes normalizing the distinct names, in chunks.
+    :param return_ids: boolean
+        Whether to return integer block ids with the block names, instead
+        of the names.
 
     Returns
     -------
-    :returns: numpy array
+    :returns: numpy array or tuple
         Array with ids of the blocks. The order of the
-        array is the same as in the ``X`` input parameter.
+        array is the same as in the ``X`` input parameter. If
+        ``return_ids``, the array of int32 ids and the array of the block
+        names they index, as returned by ``encode_blocks``.
     """
-    def last_name_first_initial(name):
-        names = normalize_name(name).split(" ", 1)
+    _, unique_names, inverse = _unique_names(X)
 
-        try:
-            name = "%s %s" % (names[0], names[1].strip()[0])
-        except IndexError:
-            name = names[0]
+    results = _map_chunks(_last_name_first_initial_chunk, unique_names,
+                          n_jobs=n_jobs)
+    keys = [key for chunk in results for key in chunk]
+
+    if return_ids:
+        # Only the keys of the distinct names are compared
+        ids, vocabulary = encode_blocks(keys)
+        return ids[inverse], vocabulary
+
+    return np.array([keys[i] for i in inverse])
+
+
+def block_sorted_neighbourhood(X, window=100):
+    """Block the signatures with sliding windows over the sorted names.
+
+    The signatures are sorted by normalized name, and every window of
+    ``window`` consecutive signatures, starting every ``(window + 1) // 2``
+    signatures, forms a block. Consecutive blocks overlap by ``window // 2``
+    signatures, so that similar names near a block boundary still share a
+    block. Unlike exact keys, this bounds the size of the blocks, hence the
+    number of pairs to compare, whatever the frequency of a name.
+
+    The clusters of the overlapping blocks are merged by BlockClustering.
+
+    Parameters
+    ----------
+    :param X: numpy array
+        Array of singletons of dictionaries, with the ``author_name`` field.
+    :param window: integer
+        Size of the blocks, at least 2.
+
+    Returns
+    -------
+    :returns: numpy array, shape (n_samples, 2)
+        The two block ids of every signature, equal for the signatures in
+        a single block, e.g. in the first half window. The order of the
+        array is the same as in the ``X`` input parameter.
+    """
+    if window < 2:
+        raise ValueError("Invalid value for window. It must be at least 2.")
 
-        return name
+    names = [normalize_name(signature["author_name"])
+             for signature in X[:, 0]]
+    order = sorted(range(len(names)), key=names.__getitem__)
 
-    blocks = []
+    # Position of every signature in the sorted order
+    positions = np.empty(len(names), dtype=np.int)
+    positions[order] = np.arange(len(names))
 
-    for signature in X[:, 0]:
-        blocks.append(last_name_first_initial(signature["author_name"]))
+    step = (window + 1) // 2
+    last = positions // step
+    previous = np.where((last > 0) & (positions < (last - 1) * step + window),
+                        last - 1, last)
 
-    return np.array(blocks)
+    return np.column_stack((last, previous))
@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Beard.
+# Copyright (C) 2015 CERN.
+#
+# Beard is a free software; you can redistribute it and/or modify it
+# under the terms of the Revised BSD License; see LICENSE file for
+# more details.
+
+"""Pool of workers for fitting clustering estimators on blocks.
+
+.. codeauthor:: Gilles Louppe <g.louppe@cern.ch>
+.. codeauthor:: Mateusz Susik <mateusz.susik@cern.ch>
+
+"""
+
+from __future__ import print_function
+
+from collections import deque
+from collections import namedtuple
+import multiprocessing as mp
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from six.moves import cPickle as pickle
+from six.moves import queue
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from sklearn.base import BaseEstimator
+from sklearn.base import clone
+from sklearn.base import ClusterMixin
+
+from .blocking_funcs import block_single
+
+
+class _SingleClustering(BaseEstimator, ClusterMixin):
+    def fit(self, X, y=None):
+        self.labels_ = block_single(X)
+        return self
+
+    def partial_fit(self, X, y=None):
+        self.labels_ = block_single(X)
+        return self
+
+    def predict(self, X):
+        return block_single(X)
+
+
+class _BlockLabels(object):
+
+    """Labels of a block, returned by a worker instead of the clusterer."""
+
+    def __init__(self, labels):
+        self.labels_ = labels
+
+    def predict(self, X):
+        raise ValueError("The clusterer of this block was not kept, because "
+                         "it was fitted with transport='shared'.")
+
+
+# A unit of work sent to the workers. ``clusterer`` is the clusterer fitted
+# on the block during a previous call to ``partial_fit``, if any. If
+# ``return_labels`` is True, only the labels are sent back. ``sent`` is the
+# time at which the task was submitted to the pool.
+_Task = namedtuple("_Task", ["block", "X", "y", "estimator", "clusterer",
+                             "fit", "partial_fit", "verbose",
+                             "return_labels", "sent"])
+
+# Reference to a slice of data published by _SharedBlocks. ``kind`` is one
+# of "rows" (range of rows of an array saved with numpy) or "pickle" (range
+# of bytes of a file of pickled blocks).
+_SharedSlice = namedtuple("_SharedSlice", ["path", "start", "stop", "kind"])
+
+
+def _load_slice(data):
+    """Load the data referenced by a _SharedSlice."""
+    if not isinstance(data, _SharedSlice):
+        return data
+
+    if data.kind == "pickle":
+        with open(data.path, "rb") as f:
+            f.seek(data.start)
+            return pickle.loads(f.read(data.stop - data.start))
+
+    return np.array(np.load(data.path, mmap_mode="r")[data.start:data.stop])
+
+
+class _SharedBlocks(object):
+
+    """Data of all the blocks, published once for all the workers.
+
+    The samples are written to a temporary directory, ordered by block, so
+    that the workers receive only the range of the data of their block.
+    Numerical arrays are saved with numpy and memory-mapped by the workers.
+    Distance matrices are saved one block at a time, since only the
+    distances within the blocks are needed. Other arrays, e.g. of signature
+    dictionaries, are pickled block by block into a single file, from which
+    the workers read only their range of bytes. These are still pickled and
+    unpickled once per block, as through queues: for them, only sending
+    back labels instead of clusterers saves time.
+    """
+
+    def __init__(self, X, y, order, offsets, square=False):
+        """Publish the data.
+
+        Parameters
+        ----------
+        :param X: numpy array
+            Input data, or a distance matrix if ``square`` is True.
+        :param y: numpy array or None
+            Input labels.
+        :param order: numpy array
+            Indices of the samples, ordered by block.
+        :param offsets: numpy array
+            Offsets in ``order`` at which the blocks start.
+        :param square: boolean
+            Whether both axes of X have to be sliced.
+        """
+        if not isinstance(X, np.ndarray):
+            raise ValueError("transport='shared' requires X to be a numpy "
+                             "array.")
+
+        self.offsets = offsets
+        self.directory = tempfile.mkdtemp(prefix="beard-")
+
+        try:
+            if square:
+                self.X = self._save_squares(X, order)
+            elif X.dtype.hasobject:
+                self.X = self._dump("X.pkl", X[order])
+            else:
+                self.X = self._save("X.npy", X[order], "rows")
+
+            self.y = None
+            if y is not None:
+                self.y = self._save("y.npy", np.asarray(y)[order], "rows")
+        except BaseException:
+            self.close()
+            raise
+
+    def _save(self, name, array, kind):
+        path = os.path.join(self.directory, name)
+        np.save(path, array)
+        return [_SharedSlice(path, self.offsets[i], self.offsets[i + 1], kind)
+                for i in range(len(self.offsets) - 1)]
+
+    def _save_squares(self, X, order):
+        # Only the distances within every block are needed, hence each
+        # block is saved to its own file
+        slices = []
+
+        for i in range(len(self.offsets) - 1):
+            samples = order[self.offsets[i]:self.offsets[i + 1]]
+            path = os.path.join(self.directory, "X%d.npy" % i)
+            np.save(path, X[np.ix_(samples, samples)])
+            slices.append(_SharedSlice(path, 0, len(samples), "rows"))
+
+        return slices
+
+    def _dump(self, name, array):
+        path = os.path.join(self.directory, name)
+        slices = []
+
+        with open(path, "wb") as f:
+            for i in range(len(self.offsets) - 1):
+                start = f.tell()
+                pickle.dump(array[self.offsets[i]:self.offsets[i + 1]], f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+                slices.append(_SharedSlice(path, start, f.tell(), "pickle"))
+
+        return slices
+
+    def block(self, i):
+        """Get the references to X and y for the i-th block."""
+        if self.y is None:
+            return self.X[i], None
+
+        return self.X[i], self.y[i]
+
+    def close(self):
+        """Remove the published data."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _peak_rss():
+    """Get the peak resident set size of the process, in bytes."""
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Kilobytes on Linux, bytes on Mac OS
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+
+    return peak_rss
+
+
+def _fit_block(task, worker_id=0):
+    """Fit a clusterer on the samples of a single block.
+
+    Exceptions raised while fitting are caught, so that a failing block
+    doesn't stop the worker.
+
+    Returns
+    -------
+    :returns: tuple
+        The block, the fitted clusterer (None if fitting failed) and a
+        dictionary of measurements with the keys:
+        - "block": the block;
+        - "n_samples": the number of samples in the block;
+        - "worker": the identifier of the worker in the pool;
+        - "pid": the process identifier of the worker;
+        - "queue_wait": seconds between submitting the task to the pool
+          and its start;
+        - "fit_time": seconds spent on fitting the clusterer;
+        - "peak_rss": peak resident set size of the worker process since
+          it started, in bytes, or None if it cannot be measured;
+        - "error": the formatted traceback if fitting failed, else None.
+    """
+    start_time = time.time()
+    info = {"block": task.block,
+            "n_samples": None,
+            "worker": worker_id,
+            "pid": os.getpid(),
+            "queue_wait": (start_time - task.sent
+                           if task.sent is not None else 0.0),
+            "fit_time": 0.0,
+            "peak_rss": None,
+            "error": None}
+
+    try:
+        b, X, y = task.block, _load_slice(task.X), _load_slice(task.y)
+        info["n_samples"] = len(X)
+
+        if len(X) == 1:
+            clusterer = _SingleClustering()
+        elif task.clusterer and task.partial_fit and not task.fit:
+            clusterer = task.clusterer
+        else:
+            clusterer = clone(task.estimator)
+
+        if task.verbose > 1:
+            print("Clustering %d samples on block '%s'..." % (len(X), b))
+
+        fit_start_time = time.time()
+
+        if task.fit or not hasattr(clusterer, "partial_fit"):
+            try:
+                clusterer.fit(X, y=y)
+            except TypeError:
+                clusterer.fit(X)
+        elif task.partial_fit:
+            try:
+                clusterer.partial_fit(X, y=y)
+            except TypeError:
+                clusterer.partial_fit(X)
+
+        info["fit_time"] = time.time() - fit_start_time
+
+        if task.return_labels:
+            clusterer = _BlockLabels(np.asarray(clusterer.labels_,
+                                                dtype=np.int32))
+
+    except Exception:
+        clusterer = None
+        info["error"] = traceback.format_exc()
+
+    info["peak_rss"] = _peak_rss()
+
+    return task.block, clusterer, info
+
+
+def _worker(worker_id, inbox, outbox):
+    """Run the tasks received in ``inbox`` until ``None`` is received."""
+    message = inbox.get()
+
+    while message is not None:
+        seq, task = message
+        outbox.put((worker_id, seq, _fit_block(task, worker_id)))
+        message = inbox.get()
+
+
+class WorkerPool(object):
+
+    """Long-lived pool of workers for fitting clusterers on blocks.
+
+    Starting processes is expensive compared to clustering small blocks.
+    A pool can therefore be started once and shared by successive calls to
+    `BlockClustering.fit` and `BlockClustering.partial_fit`, for example
+    through ``BlockClustering(pool=pool)``. Every worker has its own inbox
+    and receives a new block only once it has returned the previous one.
+
+    The workers are either processes or threads. Threads avoid starting
+    processes and pickling the blocks, and run in parallel whenever the
+    base estimator releases the GIL, e.g. in the distance computations of
+    numpy and in ``scipy.cluster.hierarchy.linkage``.
+
+    A block whose fitting raises an exception is reported as failed without
+    affecting the other blocks. A worker process which dies, e.g. killed
+    for using too much memory, is restarted and its block is sent again up
+    to `max_retries` times, after which the block is reported as failed.
+
+    The pool must be shut down with `close` (or used as a context manager)
+    once it is no longer needed. Workers are daemonic, hence a pool which
+    is not closed doesn't prevent the interpreter from exiting.
+
+    Example
+    -------
+    .. code:: python
+
+        with WorkerPool(n_jobs=4) as pool:
+            clusterer = BlockClustering(base_estimator=..., pool=pool)
+            for X_batch in batches:
+                clusterer.partial_fit(X_batch)
+    """
+
+    def __init__(self, n_jobs=1, backend="processes", max_retries=1):
+        """Initialize.
+
+        Parameters
+        ----------
+        :param n_jobs: int
+            Number of workers to use. If negative, ``cpu_count() + 1 +
+            n_jobs`` workers are used, e.g. -1 for one worker per CPU.
+
+        :param backend: string, default "processes"
+            The kind of workers.
+            - "processes": use `n_jobs` processes;
+            - "threads": use `n_jobs` threads;
+            - "serial": run every task in the calling thread.
+
+        :param max_retries: int, default 1
+            How many times a task is sent again after the death of the
+            worker running it.
+        """
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.max_retries = max_retries
+        self._workers = []
+        self._inboxes = []
+        self._outbox = None
+        self._running = False
+
+    def __reduce__(self):
+        """Pickle the parameters only; the copy is a pool not started yet.
+
+        Workers and queues can't be pickled, hence estimators holding a
+        pool, e.g. ``BlockClustering(pool=pool)``, can be pickled anyway.
+        """
+        return (WorkerPool, (self.n_jobs, self.backend, self.max_retries))
+
+    @property
+    def running(self):
+        """Check whether the workers are started."""
+        return self._running
+
+    def _queue(self):
+        if self.backend == "processes":
+            return mp.Queue()
+        else:
+            return queue.Queue()
+
+    def _spawn(self, worker_id):
+        """Start the worker ``worker_id``, replacing the previous one."""
+        inbox = self._queue()
+
+        if self.backend == "processes":
+            make_worker = mp.Process
+        else:
+            make_worker = threading.Thread
+
+        worker = make_worker(target=_worker,
+                             args=(worker_id, inbox, self._outbox))
+        worker.daemon = True
+        worker.start()
+
+        if worker_id < len(self._workers):
+            self._inboxes[worker_id] = inbox
+            self._workers[worker_id] = worker
+        else:
+            self._inboxes.append(inbox)
+            self._workers.append(worker)
+
+    def start(self):
+        """Start the workers, if they are not running yet.
+
+        Returns
+        -------
+        :returns: self
+        """
+        if self.running:
+            return self
+
+        n_jobs = self.n_jobs
+        if n_jobs < 0:
+            n_jobs = max(mp.cpu_count() + 1 + n_jobs, 1)
+        if n_jobs < 1:
+            raise ValueError("n_jobs must be a non-zero integer.")
+
+        if self.backend not in ("processes", "threads", "serial"):
+            raise ValueError("Invalid value for backend. Allowed values are "
+                             "'processes', 'threads' or 'serial'.")
+
+        if self.backend != "serial":
+            self._outbox = self._queue()
+
+            for worker_id in range(n_jobs):
+                self._spawn(worker_id)
+
+        self._running = True
+
+        return self
+
+    def close(self):
+        """Tell the workers to finish and wait for them to exit."""
+        for inbox in self._inboxes:
+            inbox.put(None)
+
+        for worker in self._workers:
+            worker.join()
+
+        self._workers = []
+        self._inboxes = []
+        self._outbox = None
+        self._running = False
+
+    def _receive(self, assigned):
+        """Wait for the result of one of the ``assigned`` tasks.
+
+        Parameters
+        ----------
+        :param assigned: dict
+            Maps the identifiers of the busy workers to the pair
+            ``(seq, task)`` they are running.
+
+        Returns
+        -------
+        :returns: tuple
+            The identifier of the worker and the result of its task, or None
+            instead of the result if the worker died. The worker is not busy
+            anymore.
+        """
+        while True:
+            try:
+                worker_id, seq, result = self._outbox.get(timeout=0.1)
+            except queue.Empty:
+                for worker_id, worker in enumerate(self._workers):
+                    if not worker.is_alive():
+                        self._spawn(worker_id)
+                        if worker_id in assigned:
+                            return worker_id, None
+                continue
+
+            # Ignore results of tasks that were already given up on
+            if assigned.get(worker_id, (None, ))[0] == seq:
+                return worker_id, result
+
+    def imap_unordered(self, tasks):
+        """Run tasks on the workers.
+
+        Tasks are sent to the workers in the order in which they are
+        consumed from ``tasks``. Only one task is assigned to a worker at a
+        time. Only one call to this method can be active at a time.
+
+        Parameters
+        ----------
+        :param tasks: iterable
+            Tasks to run.
+
+        Returns
+        -------
+        :returns: generator
+            Results of the tasks, in the order of completion.
+        """
+        self.start()
+
+        # All the tasks are submitted at once, even though they are only
+        # consumed once a worker is free
+        submitted = time.time()
+        tasks = (task if task.sent is not None else
+                 task._replace(sent=submitted) for task in tasks)
+
+        if self.backend == "serial":
+            for task in tasks:
+                yield _fit_block(task)
+            return
+
+        retries = deque()
+        n_retries = {}
+        assigned = {}
+        seq = 0
+
+        try:
+            while True:
+                for worker_id in range(len(self._workers)):
+                    if worker_id in assigned:
+                        continue
+
+                    if retries:
+                        task_seq, task = retries.popleft()
+                    else:
+                        task = next(tasks, None)
+                        if task is None:
+                            break
+                        task_seq, seq = seq, seq + 1
+
+                    assigned[worker_id] = (task_seq, task)
+                    self._inboxes[worker_id].put((task_seq, task))
+
+                if not assigned:
+                    return
+
+                worker_id, result = self._receive(assigned)
+                task_seq, task = assigned.pop(worker_id)
+
+                if result is None:
+                    n_retries[task_seq] = n_retries.get(task_seq, 0) + 1
+
+                    if n_retries[task_seq] <= self.max_retries:
+                        retries.append((task_seq, task))
+                        continue
+
+                    result = (task.block, None, {
+                        "block": task.block, "n_samples": None,
+                        "worker": worker_id, "pid": None,
+                        "queue_wait": 0.0, "fit_time": 0.0,
+                        "peak_rss": None,
+                        "error": "The worker died while fitting the block."})
+
+                yield result
+
+        finally:
+            # Wait for the tasks still running, so that the pool can be
+            # reused when the caller stops early.
+            while assigned:
+                worker_id, _ = self._receive(assigned)
+                del assigned[worker_id]
+
+    def __enter__(self):
+        """Start the workers."""
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Shut down the workers."""
+        self.close()
+
+    def __deepcopy__(self, memo):
+        """Return the pool itself.
+
+        The pool is a shared resource: copies of an estimator (e.g. made by
+        ``sklearn.base.clone``) keep using the same workers.
+        """
+        return self
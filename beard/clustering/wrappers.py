@@ -13,13 +13,377 @@
 .. codeauthor:: Hussein Al-Natsheh <h.natsheh@ciapple.com>
 
 """
+from functools import partial
 import numpy as np
+import six
 
 import scipy.cluster.hierarchy as hac
+from scipy.sparse import coo_matrix
+from scipy.sparse import issparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial.distance import cdist
+from scipy.spatial.distance import squareform
 
 from sklearn.base import BaseEstimator
 from sklearn.base import ClusterMixin
 
+from ..metrics import b3_f_score
+from ..metrics import paired_f_score
+
+
+def _incremental_scores(linkage, y, thresholds, scoring):
+    """Score the flat clusters at every threshold, merge by merge.
+
+    The flat clusters at a threshold t, with criterion="distance", result
+    from the merges of the linkage matrix whose cophenetic distance is at
+    most t. The merges are therefore applied once, by increasing distance,
+    and the contingency table of every cluster with the labels of y is
+    merged into the one of the larger cluster. The B^3 and pairwise scores
+    of the labeled samples are updated in O(size of the smaller table) per
+    merge, instead of being recomputed for every threshold.
+
+    Parameters
+    ----------
+    :param linkage: numpy array
+        The linkage matrix.
+    :param y: array-like, shape (n_samples, )
+        Labels, -1 standing for unknown labels.
+    :param thresholds: numpy array
+        The thresholds to score.
+    :param scoring: string
+        "b3" for b3_f_score, "paired" for paired_f_score.
+
+    Returns
+    -------
+    :returns: numpy array
+        The F-score of the labeled samples at every threshold.
+    """
+    n_samples = len(linkage) + 1
+    y = np.asarray(y)
+    labeled = y != -1
+    _, classes = np.unique(y[labeled], return_inverse=True)
+    class_sizes = np.bincount(classes).astype(np.float)
+    n_labeled = float(len(classes))
+
+    # Contingency table of every cluster, for the labeled samples
+    tables = [None] * (2 * n_samples - 1)
+    sizes = np.zeros(2 * n_samples - 1, dtype=np.int)
+    squares = np.zeros(2 * n_samples - 1)
+
+    for i, c in zip(np.flatnonzero(labeled), classes):
+        tables[i] = {c: 1}
+        sizes[i] = 1
+        squares[i] = 1
+
+    # B^3 precision and recall times n_labeled, true positive pairs and
+    # pairs of samples in the same cluster
+    precision = n_labeled
+    recall = np.sum(1. / class_sizes[classes])
+    true_positives = 0.
+    pred_pairs = 0.
+    true_pairs = np.sum(class_sizes * (class_sizes - 1) / 2.)
+
+    merges = np.argsort(hac.maxdists(linkage), kind="mergesort")
+    heights = hac.maxdists(linkage)[merges]
+    order = np.argsort(thresholds, kind="mergesort")
+    scores = np.empty(len(thresholds))
+    k = 0
+
+    for t in order:
+        while k < len(merges) and heights[k] <= thresholds[t]:
+            node = n_samples + merges[k]
+            a, b = linkage[merges[k], :2].astype(np.int)
+            k += 1
+
+            sizes[node] = sizes[a] + sizes[b]
+            if sizes[a] < sizes[b]:
+                a, b = b, a
+            if sizes[b] == 0:
+                tables[node] = tables[a]
+                squares[node] = squares[a]
+                continue
+
+            large, small = tables[a], tables[b]
+            cross = 0.
+            cross_recall = 0.
+
+            for c, count in six.iteritems(small):
+                shared = large.get(c, 0)
+                cross += count * shared
+                cross_recall += count * shared / class_sizes[c]
+                large[c] = shared + count
+
+            squares[node] = squares[a] + squares[b] + 2 * cross
+            precision += (squares[node] / sizes[node] -
+                          squares[a] / sizes[a] - squares[b] / sizes[b])
+            recall += 2 * cross_recall
+            true_positives += cross
+            pred_pairs += sizes[a] * sizes[b]
+            tables[node], tables[a], tables[b] = large, None, None
+
+        if scoring == "b3":
+            p = precision / n_labeled
+            r = recall / n_labeled
+        else:
+            p = true_positives / pred_pairs if pred_pairs > 0 else 1.
+            r = true_positives / true_pairs if true_pairs > 0 else 1.
+
+        scores[t] = 2. * p * r / (p + r) if p + r > 0 else 0.
+
+    return scores
+
+
+def _candidate_thresholds(heights):
+    """Get the thresholds between consecutive heights of merges.
+
+    The threshold between a finite height h and an infinite one, e.g.
+    between the merges within the components of a sparse graph and the
+    merges of the components, is 2 * h + 1 instead of infinity, so that
+    the components can be kept apart.
+
+    Parameters
+    ----------
+    :param heights: numpy array
+        The heights of the merges, in increasing order.
+
+    Returns
+    -------
+    :returns: numpy array, shape (len(heights) + 1, )
+        The threshold below the first merge, between every two merges and
+        at the last merge.
+    """
+    bounds = np.concatenate(([0], heights, heights[-1:]))
+    lo, hi = bounds[:-1], bounds[1:]
+    thresholds = (lo + hi) / 2.0
+
+    infinite = np.isinf(hi) & np.isfinite(lo)
+    thresholds[infinite] = 2 * lo[infinite] + 1
+
+    return thresholds
+
+
+def _best_score(scores):
+    """Get the position of the best score, the last one in case of ties.
+
+    Scores within a relative tolerance of 1e-9 of the maximum are ties,
+    so that the choice doesn't depend on rounding errors, e.g. between
+    scores computed incrementally or from scratch.
+
+    Parameters
+    ----------
+    :param scores: array-like
+        The scores, NaN standing for no score.
+
+    Returns
+    -------
+    :returns: int or None
+        The position of the best score, or None if there is no score.
+    """
+    scores = np.asarray(scores, dtype=np.float)
+    valid = ~np.isnan(scores)
+
+    if not np.any(valid):
+        return None
+
+    ties = valid & np.isclose(scores, np.max(scores[valid]),
+                              rtol=1e-9, atol=1e-12)
+    return np.flatnonzero(ties)[-1]
+
+
+def _cut_n_clusters(linkage, n_clusters):
+    """Cut the tree of a linkage matrix into exactly n_clusters clusters.
+
+    The merges are applied by increasing cophenetic distance, as with
+    criterion="distance", and the n_samples - n_clusters first of them are
+    kept. The flat clusters are then labeled in a single walk down the
+    tree, in O(n_samples), instead of searching for a threshold giving
+    n_clusters clusters.
+
+    Parameters
+    ----------
+    :param linkage: numpy array
+        The linkage matrix.
+    :param n_clusters: int
+        The number of clusters, within [1; n_samples].
+
+    Returns
+    -------
+    :returns: numpy array, shape (n_samples, )
+        The labels of the samples, within [0; n_clusters).
+    """
+    n_samples = len(linkage) + 1
+    merges = np.argsort(hac.maxdists(linkage), kind="mergesort")
+    merged = np.zeros(len(linkage), dtype=np.bool)
+    merged[merges[:n_samples - n_clusters]] = True
+
+    labels = -np.ones(2 * n_samples - 1, dtype=np.int)
+    children = linkage[:, :2].astype(np.int)
+    n_labels = 0
+
+    # Number the roots of the flat clusters, walking from the root of the
+    # tree and left children first
+    stack = [2 * n_samples - 2]
+
+    while stack:
+        node = stack.pop()
+
+        if node < n_samples or merged[node - n_samples]:
+            labels[node] = n_labels
+            n_labels += 1
+        else:
+            stack.extend(children[node - n_samples, ::-1])
+
+    # Parents come after their children in the linkage matrix
+    for i in np.flatnonzero(merged)[::-1]:
+        labels[children[i]] = labels[n_samples + i]
+
+    return labels[:n_samples]
+
+
+def _edges_linkage(n_samples, rows, cols, weights):
+    """Build a single linkage matrix from the edges of a spanning forest.
+
+    The edges are merged by increasing weight, as in Kruskal's algorithm.
+    Components which are not connected by any edge are merged last, at an
+    infinite distance.
+
+    Parameters
+    ----------
+    :param n_samples: int
+        The number of samples.
+    :param rows: numpy array
+        The first sample of every edge.
+    :param cols: numpy array
+        The second sample of every edge.
+    :param weights: numpy array
+        The distance between the samples of every edge.
+
+    Returns
+    -------
+    :returns: numpy array, shape (n_samples - 1, 4)
+        The linkage matrix, as returned by scipy.cluster.hierarchy.linkage.
+    """
+    parents = np.arange(2 * n_samples - 1)
+    sizes = np.ones(2 * n_samples - 1, dtype=np.int)
+    linkage = np.empty((n_samples - 1, 4))
+    n_merges = 0
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def merge(a, b, distance):
+        node = n_samples + n_merges
+        sizes[node] = sizes[a] + sizes[b]
+        linkage[n_merges] = (min(a, b), max(a, b), distance, sizes[node])
+        parents[a] = parents[b] = node
+
+    for e in np.argsort(weights, kind="mergesort"):
+        a, b = find(rows[e]), find(cols[e])
+        if a != b:
+            merge(a, b, weights[e])
+            n_merges += 1
+
+    # Samples without any edge between them
+    roots = np.unique([find(i) for i in range(n_samples)])
+    a = roots[0]
+
+    for b in roots[1:]:
+        merge(a, b, np.inf)
+        a = n_samples + n_merges
+        n_merges += 1
+
+    return linkage
+
+
+def _condensed_row(distances, n_samples, i):
+    """Get the distances of sample i from a condensed distance matrix."""
+    j = np.arange(n_samples)
+    a, b = np.minimum(i, j), np.maximum(i, j)
+    row = distances[np.maximum(n_samples * a - a * (a + 1) // 2 + b - a - 1,
+                               0)]
+    row[i] = 0
+    return row
+
+
+def _prim_single_linkage(n_samples, distances_from):
+    """Single linkage of samples, reading their distances row by row.
+
+    The minimum spanning tree of the samples is grown with Prim's
+    algorithm, one row of distances at a time. This takes O(n_samples^2)
+    time but only O(n_samples) memory besides the distances, which are
+    either computed on demand or read, in their own type, from a square or
+    condensed matrix. scipy.cluster.hierarchy.linkage instead needs the
+    condensed matrix, and copies it if its type is not float64.
+
+    Parameters
+    ----------
+    :param n_samples: int
+        The number of samples.
+    :param distances_from: callable
+        Function returning the distances of the i-th sample to all the
+        samples, as an array of shape (n_samples, ).
+
+    Returns
+    -------
+    :returns: numpy array, shape (n_samples - 1, 4)
+        The linkage matrix.
+    """
+    in_tree = np.zeros(n_samples, dtype=np.bool)
+    nearest = np.zeros(n_samples, dtype=np.int)
+    distances = np.empty(n_samples)
+    distances.fill(np.inf)
+    cols = np.empty(n_samples - 1, dtype=np.int)
+    weights = np.empty(n_samples - 1)
+    current = 0
+
+    for k in range(n_samples - 1):
+        in_tree[current] = True
+        row = distances_from(current)
+        closer = ~in_tree & (row < distances)
+        distances[closer] = row[closer]
+        nearest[closer] = current
+
+        current = np.argmin(np.where(in_tree, np.inf, distances))
+        cols[k] = current
+        weights[k] = distances[current]
+
+    return _edges_linkage(n_samples, nearest[cols], cols, weights)
+
+
+def _sparse_single_linkage(X):
+    """Single linkage of samples, from a sparse matrix of distances.
+
+    Pairs of samples without an explicit distance, e.g. outside of a
+    k-nearest neighbours graph, are considered infinitely distant. The
+    linkage is exact if the graph contains a minimum spanning tree of all
+    the samples, and approximate otherwise.
+
+    Parameters
+    ----------
+    :param X: sparse matrix, shape (n_samples, n_samples)
+        The distances between the samples.
+
+    Returns
+    -------
+    :returns: numpy array, shape (n_samples - 1, 4)
+        The linkage matrix.
+    """
+    X = X.tocsr().astype(np.float64)
+
+    # Explicit zero distances would be dropped by minimum_spanning_tree
+    tiny = np.finfo(np.float64).tiny
+    X.data[X.data == 0] = tiny
+
+    tree = minimum_spanning_tree(X).tocoo()
+    weights = tree.data
+    weights[weights == tiny] = 0.
+
+    return _edges_linkage(X.shape[0], tree.row, tree.col, weights)
+
 
 class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
 
@@ -32,12 +396,30 @@ class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
 
     linkage_ : ndarray
         The linkage matrix.
+
+    representatives_ : ndarray
+        Samples kept for assigning new samples in `predict`, if
+        n_representatives != 0. Indices of the samples if
+        affinity == 'precomputed'.
+
+    representative_labels_ : ndarray
+        Labels of the representatives.
+
+    cut_threshold_ : float
+        The distance threshold under which `predict` assigns a new sample to
+        an existing cluster.
+
+    threshold_scores_ : ndarray, shape (n_evaluations, 2) or None
+        The scored thresholds and their scores, when the best threshold is
+        estimated with a scoring function.
     """
 
     def __init__(self, method="single", affinity="euclidean",
                  threshold=None, n_clusters=None, criterion="distance",
                  depth=2, R=None, monocrit=None, unsupervised_scoring=None,
-                 supervised_scoring=None, scoring_data=None):
+                 supervised_scoring=None, scoring_data=None,
+                 n_representatives=0, dtype=None, threshold_search="auto",
+                 max_evaluations=50, engine="scipy", cross_affinity=None):
         """Initialize.
 
         Parameters
@@ -106,6 +488,57 @@ class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
                 - scoring_data is None:
                     unsupervised_scoring(label_pred).
 
+        :param n_representatives: int or None
+            The number of samples of each cluster to keep at the end of
+            `fit`, for assigning new samples to the clusters in `predict`.
+            If None, all the samples are kept. If 0, `predict` is not
+            available.
+
+        :param dtype: numpy dtype or None
+            The type in which dense distances given by a callable or
+            precomputed affinity are kept, e.g. np.float32 to halve their
+            memory. This requires engine="mst", since
+            scipy.cluster.hierarchy.linkage copies its input to float64. If
+            None, the type of the distances is kept.
+
+        :param threshold_search: string, default "auto"
+            How the thresholds are scored when estimating the best one.
+            - "exhaustive": form the flat clusters and call the scoring
+              function at every threshold;
+            - "incremental": walk the merges of the linkage matrix once,
+              updating the score in O(merge size). This requires
+              criterion="distance", scoring_data=None, labels in y and
+              b3_f_score or paired_f_score as supervised_scoring;
+            - "bounded": score at most `max_evaluations` thresholds, first
+              on a grid of quantiles of the candidate thresholds, then on
+              finer grids around the best one;
+            - "auto": "incremental" when possible, "exhaustive" otherwise.
+
+        :param max_evaluations: int, default 50
+            The maximum number of thresholds scored when
+            threshold_search="bounded".
+
+        :param engine: string, default "scipy"
+            How the linkage matrix is built.
+            - "scipy": with scipy.cluster.hierarchy.linkage, from the
+              condensed distance matrix, in O(n_samples^2) memory;
+            - "mst": from a minimum spanning tree, for method="single"
+              only. Distances between samples are computed one row at a
+              time, in O(n_samples) memory. Precomputed or callable
+              distances are read row by row in their own type, without
+              any float64 copy. They may also be sparse matrices, e.g.
+              k-nearest neighbours graphs, in which case missing pairs are
+              considered infinitely distant.
+
+        :param cross_affinity: callable or None
+            A function returning the distances between new samples and the
+            representatives, called as cross_affinity(X_new,
+            representatives) and returning an array of shape
+            (n_new, n_representatives), e.g.
+            sklearn.metrics.pairwise.euclidean_distances. It is used by
+            `predict` when affinity is callable. If None, affinity is called
+            on the new samples and the representatives together, which
+            costs O((n_new + n_representatives)^2).
         """
         self.method = method
         self.affinity = affinity
@@ -118,6 +551,12 @@ class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
         self.unsupervised_scoring = unsupervised_scoring
         self.supervised_scoring = supervised_scoring
         self.scoring_data = scoring_data
+        self.n_representatives = n_representatives
+        self.dtype = dtype
+        self.threshold_search = threshold_search
+        self.max_evaluations = max_evaluations
+        self.engine = engine
+        self.cross_affinity = cross_affinity
 
     def fit(self, X, y=None):
         """Perform hierarchical clustering on input data.
@@ -127,7 +566,10 @@ class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
         :param X: array-like, shape (n_samples, n_features) or
                   (n_samples, n_samples)
             Input data, as an array of samples or as a distance matrix if
-            affinity == 'precomputed'.
+            affinity == 'precomputed'. Distances, precomputed or returned by
+            a callable affinity, can also be given in condensed form, as
+            returned by scipy.spatial.distance.pdist, or as a sparse
+            matrix if engine == 'mst'.
 
         :param y: array-like, shape (n_samples, )
             Input labels, in case of (semi-)supervised clustering.
@@ -137,19 +579,62 @@ class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
         -------
         :returns: self
         """
-        X = np.array(X)
+        if not issparse(X):
+            X = np.asarray(X)
         X_raw = X
-        n_samples = X.shape[0]
+
+        if self.engine not in ("scipy", "mst"):
+            raise ValueError("Invalid value for engine. Allowed values are "
+                             "'scipy' or 'mst'.")
+
+        if self.engine == "mst" and self.method != "single":
+            raise ValueError("engine='mst' requires method='single'.")
+
+        if self.dtype is not None and self.engine != "mst":
+            raise ValueError("dtype requires engine='mst', since "
+                             "scipy.cluster.hierarchy.linkage copies the "
+                             "distances to float64.")
 
         # Build linkage matrix
         if self.affinity == "precomputed" or callable(self.affinity):
             if callable(self.affinity):
                 X = self.affinity(X)
-            X_affinity = X
-            if X.ndim == 2:
-                i, j = np.triu_indices(X.shape[0], k=1)
-                X = X[i, j]
-            self.linkage_ = hac.linkage(X, method=self.method)
+
+            # Distances are kept in condensed form only, unless the scoring
+            # function needs them as given
+            X_affinity = X if self.scoring_data == "affinity" else None
+
+            if issparse(X):
+                if self.engine != "mst":
+                    raise ValueError("Sparse distances require "
+                                     "engine='mst'.")
+
+                self.linkage_ = _sparse_single_linkage(X)
+            else:
+                if self.engine == "mst":
+                    if self.dtype is not None:
+                        X = X.astype(self.dtype, copy=False)
+
+                    # Rows are read in place, from a square matrix or from
+                    # a condensed one
+                    if X.ndim == 2:
+                        self.linkage_ = _prim_single_linkage(
+                            len(X), X.__getitem__)
+                    else:
+                        n_samples = int(np.ceil(np.sqrt(2 * len(X))))
+                        self.linkage_ = _prim_single_linkage(
+                            n_samples, partial(_condensed_row, X, n_samples))
+                else:
+                    if X.ndim == 2:
+                        X = squareform(X, checks=False)
+
+                    self.linkage_ = hac.linkage(X, method=self.method)
+            del X
+        elif self.engine == "mst":
+            X_affinity = None
+            self.linkage_ = _prim_single_linkage(
+                len(X), lambda i: cdist(X[i:i + 1], X,
+                                        metric=self.affinity)[0])
         else:
             X_affinity = None
             self.linkage_ = hac.linkage(X,
@@ -165,84 +650,310 @@ class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
         # As default value we use the highest so we obtain only 1 cluster.
         best_threshold = self.linkage_[-1, 2]
         n_clusters = self.n_clusters
+        threshold = self.threshold
+        scoring = self.supervised_scoring is not None or \
+            self.unsupervised_scoring is not None
+
+        if self.threshold_search not in ("auto", "exhaustive",
+                                         "incremental", "bounded"):
+            raise ValueError("Invalid value for threshold_search. Allowed "
+                             "values are 'auto', 'exhaustive', "
+                             "'incremental' or 'bounded'.")
+
+        threshold_scores = None
+
+        if threshold is None and n_clusters is None and scoring:
+            thresholds = _candidate_thresholds(self.linkage_[:, 2])
+
+            incremental = self._incremental_scoring(y)
+
+            if self.threshold_search == "bounded":
+                thresholds, scores = self._bounded_scores(
+                    thresholds, X_raw, X_affinity, y)
+            elif incremental is not None:
+                scores = _incremental_scores(self.linkage_, y, thresholds,
+                                             incremental)
+            elif self.threshold_search == "incremental":
+                raise ValueError("threshold_search='incremental' requires "
+                                 "criterion='distance', scoring_data=None, "
+                                 "labels in y and b3_f_score or "
+                                 "paired_f_score as supervised_scoring.")
+            else:
+                scores = self._scores(thresholds, X_raw, X_affinity, y)
+
+            best = _best_score(scores[:len(thresholds)])
+            if best is not None:
+                best_threshold = thresholds[best]
+
+            threshold_scores = np.column_stack(
+                (thresholds[:len(scores)], scores[:len(thresholds)]))
+
+        self.best_threshold_ = best_threshold
+        self.threshold_scores_ = threshold_scores
+        self.n_samples_ = len(self.linkage_) + 1
+        self._labels_cache = None
+
+        if self.n_representatives != 0:
+            self._store_representatives(X_raw)
+
+        return self
+
+    def _incremental_scoring(self, y):
+        """Get the scoring function which can be updated merge by merge.
+
+        Returns
+        -------
+        :returns: string or None
+            "b3" or "paired" if the scores of the thresholds can be computed
+            incrementally, None otherwise.
+        """
+        if (self.threshold_search not in ("auto", "incremental") or
+                self.criterion != "distance" or
+                self.scoring_data is not None or
+                y is None or not np.any(np.asarray(y) != -1)):
+            return None
+
+        if self.supervised_scoring is b3_f_score:
+            return "b3"
+        elif self.supervised_scoring is paired_f_score:
+            return "paired"
+
+        return None
+
+    def _bounded_scores(self, thresholds, X_raw, X_affinity, y):
+        """Score at most `max_evaluations` thresholds, coarse to fine.
+
+        Half of the budget is spent on a grid of quantiles of the candidate
+        thresholds. Half of the remaining budget is then repeatedly spent on
+        a grid between the neighbours of the best threshold found so far.
+
+        Returns
+        -------
+        :returns: tuple
+            The evaluated thresholds and their scores, in increasing order
+            of threshold.
+        """
+        if self.max_evaluations < 1:
+            raise ValueError("max_evaluations must be positive.")
+
+        candidates = np.unique(thresholds)
+        budget = self.max_evaluations
+        evaluated = {}
+        lo, hi = 0, len(candidates) - 1
+        n_grid = max(budget // 2, 1)
+
+        while budget > 0:
+            # The bounds are included in the first grid only, afterwards
+            # they are already evaluated
+            n_points = n_grid + 2 if evaluated else n_grid
+            grid = np.unique(np.round(np.linspace(lo, hi, n_points)))
+            grid = [i for i in grid.astype(np.int)
+                    if i not in evaluated][:budget]
+
+            if not grid:
+                break
+
+            scores = self._scores(candidates[grid], X_raw, X_affinity, y)
+            if not scores:
+                break
+
+            evaluated.update(zip(grid, scores))
+            budget -= len(grid)
+            n_grid = min(max(budget // 2, 1), budget)
+
+            # Refine between the neighbours of the best threshold
+            done = sorted(evaluated)
+            position = _best_score([evaluated[i] for i in done])
+            if position is None:
+                break
+            lo = done[max(position - 1, 0)]
+            hi = done[min(position + 1, len(done) - 1)]
+
+        done = sorted(evaluated)
+
+        return candidates[done], [evaluated[i] for i in done]
+
+    def _scores(self, thresholds, X_raw, X_affinity, y):
+        """Score the flat clusters formed at every threshold.
+
+        Returns
+        -------
+        :returns: list
+            The scores, in the order of the thresholds. The list is empty if
+            no scoring function applies.
+        """
         supervised_scoring = self.supervised_scoring
         unsupervised_scoring = self.unsupervised_scoring
-        threshold = self.threshold
         ground_truth = (y is not None) and np.any(np.array(y) != -1)
-        scoring = supervised_scoring is not None or \
-            unsupervised_scoring is not None
+        scores = []
 
-        if threshold is None and n_clusters is None and scoring:
-            best_score = -np.inf
-            thresholds = np.concatenate(([0],
-                                         self.linkage_[:, 2],
-                                         [self.linkage_[-1, 2]]))
-
-            for i in range(len(thresholds) - 1):
-                t1, t2 = thresholds[i:i + 2]
-                threshold = (t1 + t2) / 2.0
-                labels = hac.fcluster(self.linkage_, threshold,
-                                      criterion=self.criterion,
-                                      depth=self.depth, R=self.R,
-                                      monocrit=self.monocrit)
-
-                if ground_truth and supervised_scoring is not None:
-                    train = (y != -1)
-
-                    if self.scoring_data == "raw":
-                        score = supervised_scoring(X_raw, y[train],
-                                                   labels[train])
-
-                    elif self.scoring_data == "affinity":
-                        score = supervised_scoring(X_affinity, y[train],
-                                                   labels[train])
+        for threshold in thresholds:
+            labels = hac.fcluster(self.linkage_, threshold,
+                                  criterion=self.criterion,
+                                  depth=self.depth, R=self.R,
+                                  monocrit=self.monocrit)
 
-                    else:
-                        score = supervised_scoring(y[train],
-                                                   labels[train])
+            if ground_truth and supervised_scoring is not None:
+                train = (y != -1)
+
+                if self.scoring_data == "raw":
+                    score = supervised_scoring(X_raw, y[train],
+                                               labels[train])
 
-                elif unsupervised_scoring is not None:
+                elif self.scoring_data == "affinity":
+                    score = supervised_scoring(X_affinity, y[train],
+                                               labels[train])
 
-                    if self.scoring_data == "raw":
-                        score = unsupervised_scoring(X_raw, labels)
+                else:
+                    score = supervised_scoring(y[train],
+                                               labels[train])
 
-                    elif self.scoring_data == "affinity":
-                        score = unsupervised_scoring(X_affinity, labels)
+            elif unsupervised_scoring is not None:
+
+                if self.scoring_data == "raw":
+                    score = unsupervised_scoring(X_raw, labels)
+
+                elif self.scoring_data == "affinity":
+                    score = unsupervised_scoring(X_affinity, labels)
 
-                    else:
-                        score = unsupervised_scoring(labels)
                 else:
-                    break
+                    score = unsupervised_scoring(labels)
+            else:
+                break
 
-                if score >= best_score:
-                    best_score = score
-                    best_threshold = threshold
+            scores.append(score)
 
-        self.best_threshold_ = best_threshold
-        self.n_samples_ = n_samples
+        return scores
 
-        return self
+    def _cut_threshold(self):
+        """Get the distance threshold of the current cut of the tree."""
+        if self.n_clusters is not None:
+            # Between the last merge kept by _cut_n_clusters and the next
+            thresholds = _candidate_thresholds(
+                np.sort(hac.maxdists(self.linkage_)))
+            return thresholds[len(self.linkage_) + 1 - self.n_clusters]
+
+        elif self.threshold is not None:
+            return self.threshold
+
+        else:
+            return self.best_threshold_
+
+    def _store_representatives(self, X):
+        """Keep samples of each cluster, for assigning new samples."""
+        if self.criterion != "distance":
+            raise ValueError("Assigning new samples requires "
+                             "criterion='distance'.")
+
+        labels = self.labels_
+        # Stable sort, so that the first samples of each cluster are kept
+        order = np.argsort(labels, kind="mergesort")
+        _, starts, counts = np.unique(labels[order], return_index=True,
+                                      return_counts=True)
+
+        if self.n_representatives is not None:
+            keep = np.arange(len(order)) - np.repeat(starts, counts)
+            order = order[keep < self.n_representatives]
+
+        if self.affinity == "precomputed":
+            self.representatives_ = order
+        else:
+            self.representatives_ = X[order]
+
+        self.representative_labels_ = labels[order]
+        self.cut_threshold_ = self._cut_threshold()
+
+    def predict(self, X):
+        """Assign new samples to the clusters found during fit.
+
+        The distance between a sample and a cluster is computed from its
+        distances to the representatives of the cluster, following the
+        linkage method: minimum for "single", maximum for "complete" and
+        mean otherwise. A sample is assigned to the closest cluster if this
+        distance is below `cut_threshold_`. Otherwise, it forms a new
+        singleton cluster. This costs O(n_new * n_representatives), instead
+        of fitting again on all the samples.
+
+        Parameters
+        ----------
+        :param X: array-like, shape (n_new, n_features) or
+                  (n_new, n_samples)
+            New samples, or their distances to the samples passed to `fit`
+            if affinity == 'precomputed'.
+
+        Returns
+        -------
+        :returns: array-like, shape (n_new, )
+            The labels of the new samples.
+        """
+        if getattr(self, "representatives_", None) is None:
+            raise ValueError("predict requires n_representatives != 0.")
+
+        X = np.array(X)
+
+        if self.affinity == "precomputed":
+            distances = X[:, self.representatives_]
+        elif callable(self.affinity) and self.cross_affinity is not None:
+            distances = np.asarray(self.cross_affinity(X,
+                                                       self.representatives_))
+        elif callable(self.affinity):
+            distances = self.affinity(np.concatenate((X,
+                                                      self.representatives_)))
+            distances = distances[:len(X), len(X):]
+        else:
+            distances = cdist(X, self.representatives_, metric=self.affinity)
+
+        # Representatives are sorted by label
+        clusters, starts = np.unique(self.representative_labels_,
+                                     return_index=True)
+
+        if self.method == "single":
+            linkage = np.minimum.reduceat(distances, starts, axis=1)
+        elif self.method == "complete":
+            linkage = np.maximum.reduceat(distances, starts, axis=1)
+        else:
+            linkage = (np.add.reduceat(distances, starts, axis=1) /
+                       np.diff(np.append(starts, distances.shape[1])))
+
+        closest = np.argmin(linkage, axis=1)
+        labels = clusters[closest]
+
+        # Samples too far from every cluster form new singletons
+        new = linkage[np.arange(len(X)), closest] > self.cut_threshold_
+        labels[new] = np.max(self.representative_labels_) + 1 + \
+            np.arange(np.sum(new))
+
+        return labels
 
     @property
     def labels_(self):
         """Compute the labels assigned to the input data.
 
         Note that labels are computed on-the-fly from the linkage matrix,
-        based on the value of self.threshold or self.n_clusters.
+        based on the value of self.threshold or self.n_clusters. They are
+        cached for as long as these parameters remain the same.
         """
+        key = (self.threshold, self.n_clusters, self.criterion, self.depth,
+               id(self.R), id(self.monocrit))
+        cache = getattr(self, "_labels_cache", None)
+
+        if cache is None or cache[0] != key:
+            cache = (key, self._compute_labels())
+            self._labels_cache = cache
+
+        return cache[1]
+
+    def _compute_labels(self):
+        """Form flat clusters from the linkage matrix."""
         n_clusters = self.n_clusters
 
         if n_clusters is not None:
             if n_clusters < 1 or n_clusters > self.n_samples_:
                 raise ValueError("n_clusters must be within [1; n_samples].")
+            elif self.criterion == "distance":
+                return _cut_n_clusters(self.linkage_, n_clusters)
             else:
-                thresholds = np.concatenate(([0],
-                                            self.linkage_[:, 2],
-                                            [self.linkage_[-1, 2]]))
-
-                for i in range(len(thresholds) - 1):
-                    t1, t2 = thresholds[i:i + 2]
-                    threshold = (t1 + t2) / 2.0
+                for threshold in _candidate_thresholds(self.linkage_[:, 2]):
                     labels = hac.fcluster(self.linkage_, threshold,
                                           criterion=self.criterion,
                                           depth=self.depth, R=self.R,
@@ -266,3 +977,116 @@ class ScipyHierarchicalClustering(BaseEstimator, ClusterMixin):
             _, labels = np.unique(labels, return_inverse=True)
 
             return labels
+
+
+class ConnectedComponentsClustering(BaseEstimator, ClusterMixin):
+
+    """Clustering of the samples connected by distances under a threshold.
+
+    The clusters are the connected components of the graph of the pairs of
+    samples at a distance lower than or equal to the threshold, i.e. the
+    flat clusters of single linkage with criterion="distance". Distances
+    are computed in chunks of rows and only the pairs under the threshold
+    are kept, so that memory grows with the number of such pairs instead of
+    n_samples^2.
+
+    Attributes
+    ----------
+    labels_ : ndarray, shape (n_samples,)
+        Array of labels assigned to the input data.
+
+    n_clusters_ : int
+        The number of clusters.
+
+    n_edges_ : int
+        The number of pairs of samples under the threshold.
+    """
+
+    def __init__(self, threshold=None, affinity="euclidean", chunk_size=1000):
+        """Initialize.
+
+        Parameters
+        ----------
+        :param threshold: float
+            The maximum distance between two samples of a pair connecting
+            them in the same cluster.
+
+        :param affinity: string or callable
+            The distance metric to use.
+            - "precomputed": assume that X is a symmetric distance matrix,
+              dense or sparse. If sparse, pairs without an explicit
+              distance are not connected;
+            - callable: a function called as affinity(X_chunk, X_other),
+              returning the distances between the samples of both arrays,
+              of shape (len(X_chunk), len(X_other));
+            - Otherwise, any value supported by
+              scipy.spatial.distance.cdist.
+
+        :param chunk_size: int, default 1000
+            The number of rows of distances computed at once.
+        """
+        self.threshold = threshold
+        self.affinity = affinity
+        self.chunk_size = chunk_size
+
+    def fit(self, X, y=None):
+        """Perform clustering on input data.
+
+        Parameters
+        ----------
+        :param X: array-like, shape (n_samples, n_features) or
+                  (n_samples, n_samples)
+            Input data, as an array of samples or as a distance matrix if
+            affinity == 'precomputed'.
+
+        :param y: ignored
+
+        Returns
+        -------
+        :returns: self
+        """
+        if self.threshold is None:
+            raise ValueError("threshold must be provided.")
+
+        if self.chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1.")
+
+        if not issparse(X):
+            X = np.asarray(X)
+
+        n_samples = X.shape[0]
+
+        if self.affinity == "precomputed" and issparse(X):
+            X = X.tocoo()
+            under = X.data <= self.threshold
+            rows, cols = X.row[under], X.col[under]
+        else:
+            rows, cols = [], []
+
+            # Pairs (i, j) with i < j, in chunks of rows
+            for start in range(0, n_samples, self.chunk_size):
+                stop = min(start + self.chunk_size, n_samples)
+
+                if self.affinity == "precomputed":
+                    distances = X[start:stop, start:]
+                elif callable(self.affinity):
+                    distances = self.affinity(X[start:stop], X[start:])
+                else:
+                    distances = cdist(X[start:stop], X[start:],
+                                      metric=self.affinity)
+
+                i, j = np.nonzero(np.asarray(distances) <= self.threshold)
+                upper = j > i
+                rows.append(start + i[upper])
+                cols.append(start + j[upper])
+
+            rows = np.concatenate(rows) if rows else np.zeros(0, np.int)
+            cols = np.concatenate(cols) if cols else np.zeros(0, np.int)
+
+        graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                           shape=(n_samples, n_samples))
+        self.n_clusters_, self.labels_ = connected_components(
+            graph, directed=False)
+        self.n_edges_ = len(rows)
+
+        return self
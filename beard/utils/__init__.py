@@ -11,6 +11,7 @@
 
 from .misc import memoize
 from .names import phonetic_tokenize_name
+from .names import phonetic_tokenize_names
 from .names import given_name_initial
 from .names import given_name
 from .names import name_initials
@@ -21,6 +22,7 @@ from .transformers import Shaper
 
 __all__ = ("memoize",
            "phonetic_tokenize_name",
+           "phonetic_tokenize_names",
            "given_name_initial",
            "given_name",
            "normalize_name",
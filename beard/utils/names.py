@@ -15,6 +15,7 @@
 """
 
 import functools
+import numpy as np
 import re
 import sys
 
@@ -88,6 +89,27 @@ def name_initials(name):
     return set([w[0] for w in name.split()])
 
 
+@memoize
+def _phonetic_algorithm(phonetic_algorithm):
+    """Get the function encoding a word with the given phonetic algorithm."""
+    if sys.version[0] == '2':
+        import fuzzy
+        dm = fuzzy.DMetaphone()
+        soundex = fuzzy.Soundex(5)
+        phonetic_algorithms = {
+            "double_metaphone": lambda y: dm(y)[0] or '',
+            "nysiis": lambda y: fuzzy.nysiis(y),
+            "soundex": lambda y: soundex(y)
+        }
+    else:
+        from ..ext.metaphone import dm
+        phonetic_algorithms = {
+            "double_metaphone": lambda y: dm(y)[0]
+        }
+
+    return phonetic_algorithms[phonetic_algorithm]
+
+
 @memoize
 def phonetic_tokenize_name(name, phonetic_algorithm="double_metaphone"):
     """Create Double Metaphone tokens from the string.
@@ -112,30 +134,76 @@ def phonetic_tokenize_name(name, phonetic_algorithm="double_metaphone"):
         exactly two elements. Only the first results of the double metaphone
         algorithm are included in tuples.
     """
-    if sys.version[0] == '2':
-        import fuzzy
-        dm = fuzzy.DMetaphone()
-        soundex = fuzzy.Soundex(5)
-        phonetic_algorithms = {
-            "double_metaphone": lambda y: dm(y)[0] or '',
-            "nysiis": lambda y: fuzzy.nysiis(y),
-            "soundex": lambda y: soundex(y)
-        }
-    else:
-        from ..ext.metaphone import dm
-        phonetic_algorithms = {
-            "double_metaphone": lambda y: dm(y)[0]
-        }
+    encode = _phonetic_algorithm(phonetic_algorithm)
 
     tokens = tokenize_name(name)
     # Use double metaphone
-    tokens = tuple(map(lambda x: tuple(map(lambda y: phonetic_algorithms[
-        phonetic_algorithm](y), x)),
-        tokens))
+    tokens = tuple(map(lambda x: tuple(map(encode, x)), tokens))
 
     return tokens
 
 
+def phonetic_tokenize_names(names, phonetic_algorithm="double_metaphone"):
+    """Create integer-coded phonetic tokens from many names at once.
+
+    Every distinct name is tokenized once and every distinct word is
+    encoded once, hence the cost depends on the number of distinct names
+    rather than on the number of names. The tokens are the same as the ones
+    of ``phonetic_tokenize_name``, replaced by their index in the
+    vocabulary.
+
+    Parameters
+    ----------
+    :param names: iterable of strings
+        Names of the authors. Usually they should be in the format:
+        surnames, first names.
+
+    :param phonetic algorithm: string
+        Which phonetic algorithm will be used. See
+        ``phonetic_tokenize_name``.
+
+    Returns
+    -------
+    :return: tuple
+        Three elements:
+        - numpy array of shape (n_names,), the index of every name among the
+          distinct names;
+        - list of pairs of tuples of integers, the surname and first name
+          tokens of every distinct name;
+        - list of strings, the tokens, indexed by their integer code.
+    """
+    encode = _phonetic_algorithm(phonetic_algorithm)
+
+    name_ids = {}
+    inverse = []
+
+    for name in names:
+        inverse.append(name_ids.setdefault(name, len(name_ids)))
+
+    word_ids = {}
+    token_ids = {}
+    vocabulary = []
+
+    def code(word):
+        try:
+            return word_ids[word]
+        except KeyError:
+            token = encode(word)
+            if token not in token_ids:
+                token_ids[token] = len(vocabulary)
+                vocabulary.append(token)
+            word_ids[word] = token_ids[token]
+            return word_ids[word]
+
+    tokens = [None] * len(name_ids)
+
+    for name, i in name_ids.items():
+        tokens[i] = tuple(tuple(code(word) for word in words)
+                          for words in tokenize_name(name))
+
+    return np.array(inverse, dtype=np.int32), tokens, vocabulary
+
+
 @memoize
 def tokenize_name(name, handle_soft_sign=True, drop_common_affixes=True):
     """Normalize the name and create tokens from it.
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Beard.
+# Copyright (C) 2015 CERN.
+#
+# Beard is a free software; you can redistribute it and/or modify it
+# under the terms of the Revised BSD License; see LICENSE file for
+# more details.
+
+"""Benchmark of the backends of block clustering.
+
+This example compares the time taken by ``BlockClustering`` to fit
+hierarchical clustering on synthetic blocks, when the blocks are fitted
+in processes, in threads or serially. The cheapest backend depends on the
+size of the blocks and on the machine.
+
+.. codeauthor:: Mateusz Susik <mateusz.susik@cern.ch>
+
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import time
+
+from sklearn.datasets import make_blobs
+from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.utils import check_random_state
+
+from beard.clustering import BlockClustering
+from beard.clustering import ScipyHierarchicalClustering
+from beard.clustering import WorkerPool
+
+
+def make_blocks(n_blocks, block_size, random_state):
+    """Generate blobs split into ``n_blocks`` blocks of ``block_size``."""
+    X, _ = make_blobs(n_samples=n_blocks * block_size, centers=10,
+                      random_state=random_state)
+    blocks = np.repeat(np.arange(n_blocks), block_size)
+
+    return X, blocks
+
+
+def benchmark(X, blocks, backend, n_jobs, n_repeats=3):
+    """Measure the best time of fitting X, among ``n_repeats`` runs."""
+    times = []
+
+    with WorkerPool(n_jobs=n_jobs, backend=backend) as pool:
+        clusterer = BlockClustering(
+            blocking="precomputed",
+            base_estimator=ScipyHierarchicalClustering(
+                affinity=euclidean_distances,
+                threshold=1.0,
+                method="average"),
+            pool=pool)
+
+        for _ in range(n_repeats):
+            start = time.time()
+            clusterer.fit(X, blocks=blocks)
+            times.append(time.time() - start)
+
+    return min(times)
+
+
+if __name__ == "__main__":
+    random_state = check_random_state(42)
+    n_jobs = 4
+    backends = ("processes", "threads", "serial")
+
+    print("%10s %10s" % ("blocks", "size") +
+          "".join("%12s" % backend for backend in backends))
+
+    for n_blocks, block_size in ((1000, 5), (200, 50), (40, 250),
+                                 (8, 1000), (4, 3000)):
+        X, blocks = make_blocks(n_blocks, block_size, random_state)
+        print("%10d %10d" % (n_blocks, block_size) +
+              "".join("%11.3fs" % benchmark(X, blocks, backend, n_jobs)
+                      for backend in backends))
@@ -7,51 +7,111 @@
 # under the terms of the Revised BSD License; see LICENSE file for
 # more details.
 
-"""Tests of _Block class.
+"""Tests of the content of the phonetic blocks.
 
 .. codeauthor:: Mateusz Susik <mateusz.susik@cern.ch>
 
 """
 
+import gc
+import numpy as np
 import pytest
 
-from beard.clustering.blocking_funcs import _Block
+from beard.clustering.blocking_funcs import _BlockTable
+from beard.clustering.blocking_funcs import _GivenNames
 
 
 @pytest.fixture
-def block():
-    """Create a block for mr Abc, D. Vasquez."""
-    return _Block(*(("ABC",), ("D", "VSQ")))
-
-
-def test_add_signature(block):
-    """Test adding signatures to the cluster."""
-    assert block._content[("ABC",)][("D", "VSQ")] == 1
-    block.add_signature(*(("ABC",), ("D", "VSQ")))
-    assert block._content[("ABC",)][("D", "VSQ")] == 2
-    block.add_signature(*(("ABC",), ("E",)))
-    assert block._content[("ABC",)][("E",)] == 1
-    block.add_signature(*(("ABD",), ("D", "VSQ",)))
-    assert block._content[("ABD",)][("D", "VSQ")] == 1
-    block.add_signature(*(("ABC", ""), ("D", "VSQ")))
+def table():
+    """Create blocks for mr Abc, D. Vasquez and mr Def, E."""
+    table = _BlockTable()
+    table.add([1, 2], [(1,), (2,)], [(4, 9), (5,)], [1, 1])
+    return table
+
+
+def test_add(table):
+    """Test adding signatures to the blocks."""
+    assert table.count(1, (1,), (4, 9)) == 1
+    table.add([1, 1], [(1,), (1,)], [(4, 9), (5,)], [1, 2])
+    assert table.count(1, (1,), (4, 9)) == 2
+    assert table.count(1, (1,), (5,)) == 2
     # Check handling of multiple surnames
-    block.add_signature(*(("ABD", "EFG"), ("D", "VSQ",)))
-    assert block._content[("ABD", "EFG")][("D", "VSQ")] == 1
-    assert block._content[("ABC",)][("D", "VSQ")] == 2
+    table.add([1], [(7, 1)], [(4, 9)], [1])
+    assert table.count(1, (7, 1), (4, 9)) == 1
+    assert table.count(1, (1,), (4, 9)) == 2
+    assert table.count(1, (2,), (4, 9)) == 0
+    assert table.count(3, (1,), (4, 9)) == 0
+
+
+def test_contains(table):
+    """Test looking up blocks and surnames."""
+    table.add([3], [(6, 3)], [()], [1])
+
+    assert list(table.has_blocks([1, 2, 3, 4, 0])) == \
+        [True, True, True, False, False]
+    assert list(table.contains([1, 1, 2, 3, 3], [(1,), (2,), (2,), (6, 3),
+                                                 (3,)])) == \
+        [True, False, True, True, False]
+    assert list(table.contains([], [])) == []
+    assert list(_BlockTable().contains([1], [(1,)])) == [False]
+    assert table.given_names(1, (1,)) == [(4, 9)]
+    assert table.given_names(1, (2,)) == []
+
+    # Tuples which cannot be packed into an integer
+    long_names = (1, 2, 3, 4)
+    assert not table.contains([4], [long_names])[0]
+    table.add([4], [long_names], [long_names], [1])
+    assert table.contains([4], [long_names])[0]
+    assert table.count(4, long_names, long_names) == 1
+    assert table.given_names(4, long_names) == [long_names]
 
 
-def test_compare_tokens_from_last(block):
+def test_matches_from_last():
     """Test comparing tokens from the back."""
-    assert block.compare_tokens_from_last(("VSQ",), ("ABC",))
-    assert block.compare_tokens_from_last(("C", "D", "VSQ",), ("ABC",))
-    with pytest.raises(KeyError) as excinfo:
-        block.compare_tokens_from_last(("VSQ",), ("DEF"))
-        assert "cluster doesn't contain a key" in str(excinfo.value)
-    assert not block.compare_tokens_from_last(("VSD",), ("ABC",))
-    assert not block.compare_tokens_from_last(("DGM", "VSQ"), ("ABC",))
-
-
-def test_contains(block):
-    """Test contains method."""
-    assert block.contains(("ABC",))
-    assert not block.contains(("DEF",))
+    given_names = _GivenNames([("D", "VSQ")])
+    assert given_names.matches_from_last(("VSQ",))
+    assert given_names.matches_from_last(("C", "D", "VSQ",))
+    assert not given_names.matches_from_last(("VSD",))
+    assert not given_names.matches_from_last(("DGM", "VSQ"))
+    assert not _GivenNames([]).matches_from_last(("VSQ",))
+    assert _GivenNames([()]).matches_from_last(("VSQ",))
+
+
+def test_block_table_memory():
+    """Test that the block table is smaller than nested dictionaries."""
+    tracemalloc = pytest.importorskip("tracemalloc")
+    random_state = np.random.RandomState(0)
+    signatures = [((int(s),), tuple(int(g) for g in given))
+                  for s, given in zip(
+                      random_state.randint(2000, size=20000),
+                      random_state.randint(5000, size=(20000, 2)))]
+
+    def retained(build):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            content = build()
+            gc.collect()
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del content
+        return size
+
+    def build_dictionaries():
+        blocks = {}
+        for surnames, given_names in signatures:
+            content = blocks.setdefault(surnames[0], {}).setdefault(
+                surnames, {})
+            content[given_names] = content.get(given_names, 0) + 1
+        return blocks
+
+    def build_table():
+        table = _BlockTable()
+        table.add([surnames[0] for surnames, _ in signatures],
+                  [surnames for surnames, _ in signatures],
+                  [given_names for _, given_names in signatures],
+                  np.ones(len(signatures)))
+        return table
+
+    assert retained(build_table) * 3 < retained(build_dictionaries)
@@ -14,13 +14,19 @@
 """
 from __future__ import division
 
+from functools import partial
 import numpy as np
+import os
+import pickle
 from numpy.testing import assert_equal
 from numpy.testing import assert_array_equal
 
 from pytest import mark
 import pytest
 
+from sklearn.base import BaseEstimator
+from sklearn.base import clone
+from sklearn.base import ClusterMixin
 from sklearn.cluster import AgglomerativeClustering
 from sklearn.cluster import MiniBatchKMeans
 from sklearn.datasets import make_blobs
@@ -28,7 +34,15 @@ from sklearn.metrics.pairwise import euclidean_distances
 from sklearn.utils import check_random_state
 
 from beard.clustering import BlockClustering
+from beard.clustering import block_phonetic
+from beard.clustering import block_single
+from beard.clustering import encode_blocks
+from beard.clustering import plan_blocking
 from beard.clustering import ScipyHierarchicalClustering
+from beard.clustering import WorkerPool
+from beard.clustering.blocking import _BlockIndex
+from beard.clustering.pool import _load_slice
+from beard.clustering.pool import _SharedBlocks
 from beard.metrics import paired_f_score
 
 random_state = check_random_state(42)
@@ -39,6 +53,27 @@ def _distance(X_ids):
     return euclidean_distances(X[X_ids.ravel()])
 
 
+def _object_distance(X_ids):
+    return euclidean_distances(X[X_ids.ravel().astype(np.int)])
+
+
+class _FaultyClustering(BaseEstimator, ClusterMixin):
+    """Put all samples in one cluster, but fail on blocks of given size."""
+
+    def __init__(self, fail_on=None, crash=False):
+        self.fail_on = fail_on
+        self.crash = crash
+
+    def fit(self, X, y=None):
+        if len(X) == self.fail_on:
+            if self.crash:
+                os._exit(1)
+            raise ValueError("Faulty block.")
+
+        self.labels_ = np.zeros(len(X), dtype=np.int)
+        return self
+
+
 @mark.parametrize('n_jobs', (1, 2))
 def test_fit(n_jobs):
     """Test fit."""
@@ -116,6 +151,368 @@ def test_partial_fit():
     assert_equal(paired_f_score(c1, c2), 1.0)
 
 
+def test_pool():
+    """Test reusing workers across calls."""
+    blocks = (y <= 1)
+
+    with WorkerPool(n_jobs=2) as pool:
+        clusterer = BlockClustering(
+            blocking="precomputed",
+            base_estimator=MiniBatchKMeans(n_clusters=2),
+            pool=pool)
+        clusterer.partial_fit(X[y <= 1], blocks=blocks[y <= 1])
+        clusterer.partial_fit(X[y > 1], blocks=blocks[y > 1])
+        assert_equal(len(clusterer.clusterers_), 2)
+        assert pool.running
+
+        # A pickled pool is rebuilt without its workers
+        copy = pickle.loads(pickle.dumps(clusterer))
+        assert not copy.pool.running
+        assert_equal(2, copy.pool.n_jobs)
+        assert_array_equal(clusterer.labels_, copy.labels_)
+
+    assert not pool.running
+
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=AgglomerativeClustering(n_clusters=2,
+                                               linkage="complete"),
+        n_jobs=2, pool="persistent")
+    clusterer.fit(X, blocks=blocks)
+    workers = clusterer._persistent_pool._workers
+    clusterer.fit(X, blocks=blocks)
+    assert clusterer._persistent_pool._workers is workers
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+    clusterer.close()
+    assert not hasattr(clusterer, "_persistent_pool")
+
+    with pytest.raises(ValueError):
+        BlockClustering(pool="foobar").fit(X)
+
+
+def test_block_index():
+    """Test indexing the samples of every block."""
+    index = _BlockIndex(np.array(["b", "a", "b", "c", "a", "b"]))
+
+    assert_equal(len(index), 3)
+    assert_array_equal(["a", "b", "c"], index.keys)
+    assert_array_equal([2, 3, 1], index.sizes)
+    assert_array_equal([1, 4], index.samples(0))
+    assert_array_equal([0, 2, 5], index.samples(1))
+    assert_array_equal([3], index.samples(2))
+
+
+@mark.parametrize('backend', ("processes", "threads", "serial"))
+def test_backend(backend):
+    """Test the kinds of workers."""
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=ScipyHierarchicalClustering(n_clusters=2,
+                                                   method="complete"),
+        n_jobs=2, backend=backend)
+    clusterer.fit(X, blocks=(y <= 1))
+
+    assert_equal(len(clusterer.clusterers_), 2)
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+
+    with pytest.raises(ValueError):
+        clusterer.set_params(backend="foobar").fit(X, blocks=(y <= 1))
+
+
+def test_schedule():
+    """Test dispatching the largest blocks first."""
+    blocks = np.zeros(len(X), dtype=np.int)
+    blocks[:10] = 1
+    blocks[10:40] = 2
+
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=MiniBatchKMeans(n_clusters=2),
+        schedule="largest_first")
+    order = [b for b, _, _ in clusterer._blocks(X, None,
+                                                _BlockIndex(blocks))]
+    assert_array_equal([0, 2, 1], order)
+
+    clusterer.fit(X, blocks=blocks)
+    assert_equal(sorted(clusterer.block_fit_times_), [0, 1, 2])
+    assert clusterer.fit_time_ >= 0
+
+    with pytest.raises(ValueError):
+        clusterer.set_params(schedule="foobar").fit(X, blocks=blocks)
+
+
+@mark.parametrize('n_jobs', (1, 2))
+def test_shared_transport(n_jobs):
+    """Test publishing the data once for all the workers."""
+    blocks = (y <= 1)
+
+    # Array of features
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=AgglomerativeClustering(n_clusters=2,
+                                               linkage="complete"),
+        n_jobs=n_jobs, transport="shared")
+    clusterer.fit(X, blocks=blocks)
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+
+    with pytest.raises(ValueError):
+        clusterer.predict(X, blocks=blocks)
+    with pytest.raises(ValueError):
+        clusterer.partial_fit(X, blocks=blocks)
+
+    # Precomputed affinity
+    clusterer = BlockClustering(
+        affinity="precomputed",
+        blocking="precomputed",
+        base_estimator=ScipyHierarchicalClustering(affinity="precomputed",
+                                                   n_clusters=2,
+                                                   method="complete"),
+        n_jobs=n_jobs, transport="shared")
+    clusterer.fit(euclidean_distances(X), y=y, blocks=blocks)
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+
+    # Only the distances within the blocks are published
+    distances = euclidean_distances(X)
+    index = _BlockIndex(np.column_stack((blocks, y)))
+    shared = _SharedBlocks(distances, None, index.order, index.offsets,
+                           square=True)
+    try:
+        for i in range(len(index)):
+            samples = index.samples(i)
+            assert_array_equal(distances[np.ix_(samples, samples)],
+                               _load_slice(shared.block(i)[0]))
+        assert sum(os.path.getsize(os.path.join(shared.directory, name))
+                   for name in os.listdir(shared.directory)) < \
+            distances.nbytes
+    finally:
+        shared.close()
+
+    # Array of objects
+    X_ids = np.empty((len(X), 1), dtype=object)
+    X_ids[:, 0] = list(range(len(X)))
+
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=AgglomerativeClustering(n_clusters=2,
+                                               linkage="complete",
+                                               affinity=_object_distance),
+        n_jobs=n_jobs, transport="shared")
+    clusterer.fit(X_ids, blocks=blocks)
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+
+
+def test_fit_stream():
+    """Test fitting on a stream of chunks."""
+    blocks = (y <= 1)
+    chunks = [(X[i:i + 30], y[i:i + 30], blocks[i:i + 30])
+              for i in range(0, len(X), 30)]
+
+    clusterer1 = BlockClustering(
+        blocking="precomputed",
+        base_estimator=ScipyHierarchicalClustering(n_clusters=2,
+                                                   method="complete"),
+        n_jobs=2)
+    clusterer1.fit_stream(iter(chunks))
+
+    clusterer2 = clone(clusterer1)
+    clusterer2.fit(X, blocks=blocks)
+
+    assert_equal(len(clusterer1.clusterers_), 2)
+    assert_array_equal(clusterer2.blocks_, clusterer1.blocks_)
+    assert_array_equal(clusterer2.labels_, clusterer1.labels_)
+
+    # Chunks of samples only
+    clusterer = BlockClustering(
+        base_estimator=ScipyHierarchicalClustering(n_clusters=4,
+                                                   method="complete"))
+    clusterer.fit_stream(X[i:i + 7] for i in range(0, len(X), 7))
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+
+    with pytest.raises(ValueError):
+        clusterer.fit_stream([])
+
+
+@mark.parametrize('return_ids', (False, True))
+def test_fit_stream_blocking_names(return_ids):
+    """Test that a stream is blocked as a whole, from the author names."""
+    names = ["Smith, John", "Smith, Paul", "Smith, Anna", "Doe, John",
+             "Smith, J.", "Smith, P.", "Smith, A.", "Smith, Anna"]
+    signatures = np.array([[{"author_name": name}] for name in names])
+
+    clusterer = BlockClustering(
+        blocking=partial(block_phonetic, threshold=3, return_ids=return_ids),
+        base_estimator=_FaultyClustering(), backend="serial")
+    clusterer.fit(signatures)
+    blocks = clusterer.blocks_
+    vocabulary = clusterer.block_vocabulary_
+
+    clusterer.fit_stream(signatures[i:i + 2] for i in range(0, 8, 2))
+    assert_array_equal(blocks, clusterer.blocks_)
+    assert_equal(vocabulary, clusterer.block_vocabulary_)
+    # The Smith block is split, even if no chunk is above the threshold
+    assert_equal(len(clusterer.clusterers_), 4)
+    assert_array_equal(clusterer.labels_, [1, 2, 0, 3, 1, 2, 0, 0])
+
+    # Blocking functions of the whole data are not supported otherwise
+    clusterer.set_params(blocking=lambda X: block_phonetic(X, threshold=3))
+    with pytest.raises(ValueError):
+        clusterer.fit_stream(signatures[i:i + 2] for i in range(0, 8, 2))
+
+
+@mark.parametrize('backend', ("processes", "threads", "serial"))
+def test_instrumentation(backend):
+    """Test the measurements of the blocks."""
+    events = []
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=ScipyHierarchicalClustering(n_clusters=2,
+                                                   method="complete"),
+        n_jobs=2, backend=backend, callback=events.append)
+    clusterer.fit(X, blocks=(y <= 1))
+
+    assert_equal(sorted(e["block"] for e in events), [False, True])
+    for event in events:
+        assert_equal(event["n_samples"], 50)
+        assert event["worker"] in (0, 1)
+        assert event["queue_wait"] >= 0
+        assert event["fit_time"] >= 0
+
+    if backend == "serial":
+        # The second block waits for the first one to be fitted
+        assert events[1]["queue_wait"] >= events[0]["fit_time"]
+
+    summary = clusterer.fit_summary_
+    assert_equal(summary.events, events)
+    assert_equal(summary.n_blocks, 2)
+    assert_equal(summary.n_samples, 100)
+    assert_equal(len(summary.slowest(1)), 1)
+    assert summary.wall_time >= summary.max_queue_wait
+    assert "FitSummary" in repr(summary)
+
+
+@mark.parametrize('backend', ("processes", "threads", "serial"))
+def test_errors(backend):
+    """Test the isolation of the blocks whose fitting fails."""
+    blocks = (y == 0)
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=_FaultyClustering(fail_on=25),
+        n_jobs=2, backend=backend)
+
+    with pytest.raises(RuntimeError):
+        clusterer.fit(X, blocks=blocks)
+
+    clusterer.set_params(on_error="skip")
+    clusterer.fit(X, blocks=blocks)
+    assert_equal(list(clusterer.failed_blocks_), [True])
+    assert "Faulty block." in clusterer.failed_blocks_[True]
+    assert_equal(list(clusterer.clusterers_), [False])
+    assert_array_equal(clusterer.labels_[blocks], -1)
+    assert_array_equal(clusterer.labels_[~blocks], 0)
+    assert_equal(clusterer.fit_summary_.n_failed, 1)
+
+
+def test_worker_restart():
+    """Test the restart of the workers which die."""
+    blocks = (y == 0)
+
+    with WorkerPool(n_jobs=2) as pool:
+        clusterer = BlockClustering(
+            blocking="precomputed",
+            base_estimator=_FaultyClustering(fail_on=25, crash=True),
+            pool=pool, on_error="skip")
+        clusterer.fit(X, blocks=blocks)
+        assert_equal(list(clusterer.failed_blocks_), [True])
+        assert_equal(list(clusterer.clusterers_), [False])
+
+        # The pool keeps working
+        clusterer.set_params(base_estimator=_FaultyClustering())
+        clusterer.fit(X, blocks=blocks)
+        assert_equal(len(clusterer.clusterers_), 2)
+        assert_equal(clusterer.failed_blocks_, {})
+
+
+def test_checkpoint(tmpdir):
+    """Test resuming the fitting from a checkpoint."""
+    blocks = (y == 0)
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=_FaultyClustering(fail_on=25),
+        on_error="skip", checkpoint=str(tmpdir), checkpoint_every=1)
+    clusterer.fit(X, blocks=blocks)
+    assert_equal(list(clusterer.clusterers_), [False])
+
+    # Only the failed block is fitted again
+    events = []
+    clusterer.set_params(base_estimator=_FaultyClustering(),
+                         callback=events.append)
+    clusterer.fit(X, blocks=blocks)
+    assert_equal([e["block"] for e in events], [True])
+    assert_equal(sorted(clusterer.clusterers_), [False, True])
+    assert_array_equal(clusterer.labels_[blocks], 1)
+
+    # Nothing is left to fit
+    del events[:]
+    clusterer.fit(X, blocks=blocks)
+    assert_equal(events, [])
+    assert_equal(len(clusterer.clusterers_), 2)
+
+    # Blocks of different sizes are fitted again
+    clusterer.fit(X, blocks=(y <= 1))
+    assert_equal(len(events), 2)
+
+
+@mark.parametrize('as_lists', (False, True))
+def test_overlapping_blocks(as_lists):
+    """Test merging the clusters of samples in several blocks."""
+    # Every blob is split across two blocks, but also has a block of its own
+    blocks = np.column_stack((np.arange(len(X)) % 2, y + 2))
+    if as_lists:
+        keys = blocks
+        blocks = np.empty(len(X), dtype=np.object)
+        blocks[:] = [list(k) for k in keys]
+
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=ScipyHierarchicalClustering(threshold=3.0,
+                                                   method="single"))
+    clusterer.fit(X, blocks=blocks)
+
+    assert_equal(len(clusterer.clusterers_), 6)
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+    assert_equal(paired_f_score(y, clusterer.labels_), 1.0)
+
+    with pytest.raises(ValueError):
+        clusterer.predict(X, blocks=blocks)
+
+    # Samples appearing twice in the same block are clustered once
+    index = _BlockIndex(np.column_stack((y, y)))
+    assert_array_equal(index.sizes, [25, 25, 25, 25])
+
+
+def test_integer_block_ids():
+    """Test blocks given as integer ids with their names."""
+    names = np.array(["a", "b", "c", "d"])
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=MiniBatchKMeans(n_clusters=1, random_state=0))
+    clusterer.fit(X, blocks=(y.astype(np.int32), names))
+
+    assert_equal(sorted(clusterer.clusterers_), [0, 1, 2, 3])
+    assert_equal(clusterer.block_vocabulary_, list(names))
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+
+    # Ids of another vocabulary are mapped to the names of the fit
+    pred = clusterer.predict(X, blocks=(3 - y, names[::-1]))
+    assert_array_equal(pred, clusterer.labels_)
+
+    # Unknown names have no clusterer, and are not added to the vocabulary
+    pred = clusterer.predict(X, blocks=(y, np.array(["a", "b", "c", "e"])))
+    assert_array_equal(pred[y == 3], -1)
+    assert_array_equal(pred[y != 3], clusterer.labels_[y != 3])
+    assert_equal(clusterer.block_vocabulary_, list(names))
+
+
 def test_onthefly_labels():
     """Test assigning labels on the fly."""
     clusterer = BlockClustering(
@@ -123,7 +520,9 @@ def test_onthefly_labels():
                                                    method="complete"))
     clusterer.fit(X)
     assert_array_equal([100], np.bincount(clusterer.labels_))
+    assert clusterer.labels_ is clusterer.labels_
     clusterer.clusterers_[0].set_params(n_clusters=4)
+    clusterer.clear_labels_cache()
     assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
 
 
@@ -138,6 +537,31 @@ def test_predict():
     pred = clusterer.predict(X, blocks=10 * np.ones(len(X)))
     assert_array_equal(-np.ones(len(X)), pred)
 
+    # Incremental assignment of new samples
+    clusterer = BlockClustering(
+        blocking="precomputed",
+        base_estimator=ScipyHierarchicalClustering(n_clusters=2,
+                                                   method="complete",
+                                                   n_representatives=None))
+    clusterer.fit(X, blocks=(y <= 1))
+    assert_array_equal(clusterer.labels_,
+                       clusterer.predict(X, blocks=(y <= 1)))
+
+    X_new = np.vstack((X[:2], X[:2] + 1000.0))
+    pred = clusterer.predict(X_new, blocks=[True, True, True, False])
+    assert_equal(pred[0], pred[1])
+    assert_equal(len(np.unique(pred)), 3)
+
+    # New clusters don't change the labels of the fit
+    blocks = np.append(y <= 1, False)
+    pred = clusterer.predict(np.vstack((X, X[:1] + 1000.0)), blocks=blocks)
+    assert_array_equal(clusterer.labels_, pred[:-1])
+    assert_equal(pred[-1], np.max(clusterer.labels_) + 1)
+
+    # Labels don't depend on the blocks given to predict
+    assert_array_equal(clusterer.labels_[y <= 1],
+                       clusterer.predict(X[y <= 1], blocks=(y[y <= 1] <= 1)))
+
 
 @mark.parametrize('n_jobs', (1, 2))
 def test_single_signature(n_jobs):
@@ -168,3 +592,31 @@ def test_validation():
             base_estimator=MiniBatchKMeans(n_clusters=2))
         clusterer.fit(X, blocks=(y <= 1))
         clusterer.predict(X)
+
+
+def test_plan_blocking():
+    """Test estimating the cost of a blocking strategy."""
+    plan = plan_blocking(X, block_single, pair_cost=1e-6)
+    assert_equal(plan.n_blocks, 1)
+    assert_equal(plan.sum_squares, 100 ** 2)
+    assert_equal(plan.n_pairs, 100 * 99 / 2)
+    assert_equal(plan.peak_memory, 100 ** 2 * 8)
+    assert_equal(plan.time, plan.n_pairs * 1e-6)
+    assert "BlockingPlan" in repr(plan)
+
+    def blocking(X):
+        return (X[:, 0] > 0).astype(np.int)
+
+    plan = plan_blocking(X, blocking, sample=0.5, random_state=0)
+    assert_equal(plan.n_sampled, 50)
+    assert_equal(plan.n_samples, 100)
+    assert_equal(plan.sizes.sum(), 100)
+    assert_equal(plan.histogram()[1].sum(), plan.n_blocks)
+    assert plan.time is None
+
+    plan = plan_blocking(X, lambda X: encode_blocks(blocking(X)))
+    assert_equal(plan.n_blocks, 2)
+    assert_equal(plan.sizes.sum(), 100)
+
+    with pytest.raises(ValueError):
+        plan_blocking(X, blocking, sample=0)
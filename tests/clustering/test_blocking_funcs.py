@@ -14,9 +14,13 @@
 """
 
 import numpy as np
+import pytest
 
+from beard.clustering.blocking_funcs import BlockingIndex
 from beard.clustering.blocking_funcs import block_phonetic
 from beard.clustering.blocking_funcs import block_last_name_first_initial
+from beard.clustering.blocking_funcs import block_size_histogram
+from beard.clustering.blocking_funcs import block_sorted_neighbourhood
 
 
 def run_blocking(names, expected_results, threshold=100):
@@ -55,6 +59,65 @@ def test_precluster_split():
                  threshold=1)
 
 
+def test_recursive_split():
+    """Check if huge blocks are split until they are small enough."""
+    names = ['Smith, Joe Paul', 'Smith, Joe Adam', 'Smith, Joe',
+             'Smith, Paul', 'Jones, Joe']
+    sigs = np.array([[{'author_name': name}] for name in names])
+
+    assert list(block_phonetic(sigs, threshold=1)) == \
+        ['SM0j', 'SM0j', 'SM0j', 'SM0p', 'JNS']
+    blocks = block_phonetic(sigs, threshold=1, max_splits=None)
+    assert list(blocks) == ['SM0jp', 'SM0ja', 'SM0j', 'SM0p', 'JNS']
+    assert list(block_phonetic(sigs, threshold=1, max_splits=2)) == \
+        list(blocks)
+
+    sizes, counts = block_size_histogram(blocks)
+    assert list(sizes) == [1]
+    assert list(counts) == [5]
+    sizes, counts = block_size_histogram(block_phonetic(sigs, threshold=1))
+    assert list(sizes) == [1, 3]
+    assert list(counts) == [2, 1]
+
+
+def test_blocking_index(tmpdir):
+    """Check adding signatures to a persistent blocking index."""
+    def sigs(names):
+        return np.array([[{'author_name': name}] for name in names])
+
+    names = ['Smith, Joe', 'Jones, Paul', 'Smith-Jones, Paul']
+    index = BlockingIndex(threshold=2)
+    blocks, changed = index.add(sigs(names))
+    assert list(blocks) == list(block_phonetic(sigs(names), threshold=2))
+    assert changed == {'SM0', 'JNS'}
+
+    filename = str(tmpdir.join("index.pkl"))
+    index.save(filename)
+    index = BlockingIndex.load(filename)
+
+    # The block of Smith grows above the threshold and is split
+    blocks, changed = index.add(sigs(['Smith, Adam', 'Jones, Peter']))
+    assert list(blocks) == ['SM0a', 'JNS']
+    assert changed == {'SM0', 'SM0a', 'SM0j', 'SM0p', 'JNS'}
+    assert list(index.transform(sigs(names))) == ['SM0j', 'JNS', 'SM0p']
+
+    # Repeated names count once per signature
+    index = BlockingIndex(threshold=2)
+    blocks, _ = index.add(sigs(['Jones, Paul', 'Jones, Paul', 'Jones, Ann']))
+    assert list(blocks) == ['JNSp', 'JNSp', 'JNSa']
+    assert index._sizes[(0, 'JNS')] == 3
+    assert index._sizes[(1, 'JNSp')] == 2
+
+    index = BlockingIndex(blocking="last_name_first_initial")
+    blocks, changed = index.add(sigs(['Smith, Joe', 'Smith, J.']))
+    assert list(blocks) == ['smith j', 'smith j']
+    assert changed == {'smith j'}
+    assert list(index.transform(sigs(['Smith, Joe']))) == ['smith j']
+
+    with pytest.raises(ValueError):
+        BlockingIndex(blocking="foobar")
+
+
 def test_compare_tokens_from_last_usage():
     """Check if the surnames are compared to the first_names."""
     run_blocking(['Jones, Joe', 'Smith, Joe Jones', 'Jones, Joe',
@@ -68,3 +131,54 @@ def test_block_last_name_first_initial():
     lnfi_blocking = block_last_name_first_initial(sigs)
     assert lnfi_blocking.tolist() == ['smith j', 'smith j',
                                       'smith p', 'smit j']
+
+
+def test_return_ids():
+    """Check returning integer block ids with the block names."""
+    names = ['Smith, Joe', 'Jones, Paul', 'Smith, Paul', 'Smith-Jones, J.']
+    sigs = np.array([[{'author_name': sig}] for sig in names])
+
+    for blocking in (block_phonetic, block_last_name_first_initial):
+        ids, vocabulary = blocking(sigs, return_ids=True)
+        assert ids.dtype == np.int32
+        assert len(vocabulary) == len(set(vocabulary))
+        assert list(vocabulary[ids]) == list(blocking(sigs))
+
+
+def test_parallel_blocking():
+    """Check that blocking in several processes gives the same blocks."""
+    names = ['Smith, Joe', 'Smith-Jones, Paul', 'Jones, Paul Smith',
+             'Jones-Smith, Joe', 'Smith, Adam', 'Garcia, Juan Sanchez',
+             'Sanchez-Garcia, Juan', 'Smith, J.', 'Jones, Peter'] * 3
+    sigs = np.array([[{'author_name': sig}] for sig in names])
+
+    assert list(block_phonetic(sigs, threshold=2, n_jobs=2)) == \
+        list(block_phonetic(sigs, threshold=2))
+    assert list(block_last_name_first_initial(sigs, n_jobs=2)) == \
+        list(block_last_name_first_initial(sigs))
+
+
+def test_block_sorted_neighbourhood():
+    """Block using sliding windows over the sorted names."""
+    names = ['Smith, John', 'Adams, Paul', 'Smith, J.', 'Smyth, John',
+             'Brown, Anna', 'Adams, P.', 'Jones, Joe']
+    sigs = np.array([[{'author_name': sig}] for sig in names])
+    blocks = block_sorted_neighbourhood(sigs, window=4)
+
+    # Sorted: adams p, adams paul, brown anna, jones joe, smith j,
+    # smith john, smyth john
+    assert blocks.tolist() == [[2, 1], [0, 0], [2, 1], [3, 2],
+                               [1, 0], [0, 0], [1, 0]]
+    for block in np.unique(blocks):
+        assert np.sum(np.any(blocks == block, axis=1)) <= 4
+
+    # Blocks of odd windows have the size of the window
+    blocks = block_sorted_neighbourhood(sigs, window=3)
+    assert blocks.tolist() == [[2, 2], [0, 0], [2, 1], [3, 2],
+                               [1, 0], [0, 0], [1, 1]]
+    sizes = [np.sum(np.any(blocks == block, axis=1))
+             for block in np.unique(blocks)]
+    assert sizes == [3, 3, 3, 1]
+
+    with pytest.raises(ValueError):
+        block_sorted_neighbourhood(sigs, window=1)
@@ -17,16 +17,21 @@ from __future__ import division
 
 from functools import partial
 import numpy as np
+import scipy.cluster.hierarchy as hac
+import scipy.sparse as sp
 from numpy.testing import assert_equal
 from numpy.testing import assert_array_equal
 import pytest
 
 from sklearn.datasets import make_blobs
 from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.neighbors import kneighbors_graph
 from sklearn.utils import check_random_state
 
 from beard.metrics import b3_f_score
+from beard.metrics import paired_f_score
 from beard.metrics import silhouette_score
+from beard.clustering import ConnectedComponentsClustering
 from beard.clustering import ScipyHierarchicalClustering
 
 
@@ -116,6 +121,135 @@ def test_shc_semi_supervised_scoring_data_none():
     assert_array_equal([25, 25, 25, 25], np.bincount(labels))
 
 
+@pytest.mark.parametrize('scoring', (b3_f_score, paired_f_score))
+@pytest.mark.parametrize('method', ("single", "complete", "average"))
+def test_shc_incremental_threshold_search(scoring, method):
+    """Test the incremental scoring of the thresholds of SHC."""
+    X, y = generate_data(supervised=True, affinity=False)
+    X = X + check_random_state(0).normal(scale=2.0, size=X.shape)
+
+    thresholds = []
+    for threshold_search in ("exhaustive", "incremental", "auto"):
+        clusterer = ScipyHierarchicalClustering(
+            method=method, supervised_scoring=scoring,
+            threshold_search=threshold_search)
+        clusterer.fit(X, y)
+        thresholds.append(clusterer.best_threshold_)
+
+    assert_equal(thresholds[0], thresholds[1])
+    assert_equal(thresholds[0], thresholds[2])
+
+    # Unsupported scoring
+    clusterer.set_params(threshold_search="incremental",
+                         supervised_scoring=lambda y, labels: 0.)
+    with pytest.raises(ValueError):
+        clusterer.fit(X, y)
+
+    clusterer.set_params(threshold_search="foobar")
+    with pytest.raises(ValueError):
+        clusterer.fit(X, y)
+
+
+def test_shc_threshold_search_random():
+    """Test that all the threshold searches agree on random data."""
+    for seed in range(300):
+        random_state = check_random_state(seed)
+        n_samples = random_state.randint(4, 40)
+        if random_state.rand() < 0.5:
+            X = random_state.rand(n_samples, 2)
+        else:
+            # Many equal distances, hence plateaus of equal scores
+            X = random_state.randint(0, 5, (n_samples, 2)).astype(np.float)
+        y = random_state.randint(0, random_state.randint(1, 6), n_samples)
+        y[random_state.rand(n_samples) < 0.3] = -1
+        y[0] = max(y[0], 0)
+        method = random_state.choice(["single", "complete", "average",
+                                      "ward", "weighted"])
+        scoring = (b3_f_score, paired_f_score)[seed % 2]
+
+        clusterers = [ScipyHierarchicalClustering(
+            method=method, supervised_scoring=scoring,
+            threshold_search=threshold_search).fit(X, y)
+            for threshold_search in ("exhaustive", "incremental")]
+
+        assert_equal(clusterers[0].best_threshold_,
+                     clusterers[1].best_threshold_)
+        assert_array_equal(clusterers[0].labels_, clusterers[1].labels_)
+
+
+def test_shc_bounded_threshold_search():
+    """Test the coarse to fine search of the threshold of SHC."""
+    X, y = generate_data(supervised=True, affinity=False)
+
+    exhaustive = ScipyHierarchicalClustering(
+        method="average", supervised_scoring=b3_f_score,
+        threshold_search="exhaustive")
+    exhaustive.fit(X, y)
+    assert_equal(exhaustive.threshold_scores_.shape, (len(X), 2))
+
+    clusterer = ScipyHierarchicalClustering(
+        method="average", supervised_scoring=b3_f_score,
+        threshold_search="bounded", max_evaluations=20)
+    clusterer.fit(X, y)
+
+    scores = clusterer.threshold_scores_
+    assert 0 < len(scores) <= 20
+    assert np.all(np.diff(scores[:, 0]) > 0)
+    assert_equal(scores[:, 1].max(), exhaustive.threshold_scores_[:, 1].max())
+    assert_array_equal([25, 25, 25, 25], np.bincount(clusterer.labels_))
+
+    clusterer.set_params(max_evaluations=0)
+    with pytest.raises(ValueError):
+        clusterer.fit(X, y)
+
+    clusterer.set_params(supervised_scoring=None, threshold=1.0)
+    clusterer.fit(X, y)
+    assert clusterer.threshold_scores_ is None
+
+
+def test_shc_mst_engine():
+    """Test building the single linkage from a minimum spanning tree."""
+    X, _ = generate_data(supervised=False, affinity=False)
+
+    scipy = ScipyHierarchicalClustering(method="single", n_clusters=4)
+    mst = ScipyHierarchicalClustering(method="single", n_clusters=4,
+                                      engine="mst")
+    labels = scipy.fit_predict(X)
+    # Same partition, up to the numbering of the clusters
+    assert_equal(len(set(zip(labels, mst.fit_predict(X)))), 4)
+    assert_array_equal(scipy.linkage_[:, 2], mst.linkage_[:, 2])
+    assert hac.is_valid_linkage(mst.linkage_)
+
+    # Sparse k-nearest neighbours graph
+    mst.set_params(affinity="precomputed")
+    graph = kneighbors_graph(X, 10, mode="distance")
+    assert_equal(len(set(zip(labels, mst.fit_predict(graph)))), 4)
+
+    # Disconnected components are merged at an infinite distance
+    graph = kneighbors_graph(X, 1, mode="distance")
+    mst.fit(graph)
+    assert np.isinf(mst.linkage_[-1, 2])
+
+    # ... but they can be kept apart by the threshold search
+    graph = sp.csr_matrix(([1., 2.], ([0, 2], [1, 3])), shape=(4, 4))
+    clusterer = ScipyHierarchicalClustering(
+        method="single", affinity="precomputed", engine="mst",
+        supervised_scoring=b3_f_score)
+    clusterer.fit(graph, [0, 0, 1, 1])
+    assert_array_equal([0, 0, 1, 1], clusterer.labels_)
+    assert 2 < clusterer.best_threshold_ < np.inf
+    clusterer.set_params(n_clusters=2, n_representatives=None)
+    clusterer.fit(graph)
+    assert 2 < clusterer.cut_threshold_ < np.inf
+
+    with pytest.raises(ValueError):
+        mst.set_params(method="average").fit(X)
+    with pytest.raises(ValueError):
+        scipy.set_params(affinity="precomputed").fit(graph)
+    with pytest.raises(ValueError):
+        scipy.set_params(engine="unknown").fit(X)
+
+
 def test_shc_unsupervised_scoring_data_raw():
     """Test unsupervised clustering for SHC when scoring_data='raw'."""
     X, _ = generate_data(supervised=False, affinity=False)
@@ -187,6 +321,65 @@ def test_shc_precomputed_distance():
     assert_array_equal([25, 25, 25, 25], np.bincount(labels))
 
 
+def test_shc_condensed_distance():
+    """Test using condensed distances and float32 in SHC."""
+    X, _ = generate_data(supervised=False, affinity=True)
+    i, j = np.triu_indices(len(X), k=1)
+
+    clusterer = ScipyHierarchicalClustering(affinity="precomputed",
+                                            n_clusters=4)
+    labels = clusterer.fit_predict(X[i, j])
+    assert_array_equal([25, 25, 25, 25], np.bincount(labels))
+    assert_equal(clusterer.n_samples_, len(X))
+
+    clusterer = ScipyHierarchicalClustering(affinity="precomputed",
+                                            n_clusters=4, dtype=np.float32,
+                                            engine="mst")
+    assert_equal(len(set(zip(labels, clusterer.fit_predict(X)))), 4)
+
+    def condensed_affinity(X):
+        return euclidean_distances(X)[np.triu_indices(len(X), k=1)]
+
+    X, _ = generate_data(supervised=False, affinity=False)
+    clusterer = ScipyHierarchicalClustering(affinity=condensed_affinity,
+                                            n_clusters=4, dtype=np.float32,
+                                            engine="mst")
+    labels = clusterer.fit_predict(X)
+    assert_array_equal([25, 25, 25, 25], np.bincount(labels))
+
+    # scipy.cluster.hierarchy.linkage would copy float32 to float64
+    with pytest.raises(ValueError):
+        clusterer.set_params(engine="scipy").fit(X)
+
+
+@pytest.mark.parametrize('square', (False, True))
+def test_shc_float32_memory(square):
+    """Test that float32 distances are not copied with engine='mst'."""
+    tracemalloc = pytest.importorskip("tracemalloc")
+    X = check_random_state(0).rand(500, 2)
+    condensed = euclidean_distances(X)[np.triu_indices(len(X), k=1)]
+    if square:
+        distances = euclidean_distances(X).astype(np.float32)
+    else:
+        distances = condensed.astype(np.float32)
+
+    clusterer = ScipyHierarchicalClustering(affinity="precomputed",
+                                            threshold=0.1, engine="mst",
+                                            dtype=np.float32)
+    tracemalloc.start()
+    try:
+        clusterer.fit(distances)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak < distances.nbytes / 4
+    assert_array_equal(
+        clusterer.linkage_[:, 2],
+        hac.linkage(condensed.astype(np.float32).astype(np.float64),
+                    method="single")[:, 2])
+
+
 def test_shc_n_clusters():
     """Test changing number of clusters in SHC."""
     X, _ = generate_data(supervised=False, affinity=True)
@@ -196,10 +389,25 @@ def test_shc_n_clusters():
 
     labels = clusterer.fit_predict(X)
     assert_equal(len(np.unique(labels)), 4)
+    assert clusterer.labels_ is clusterer.labels_
     clusterer.set_params(n_clusters=10)
     labels = clusterer.labels_
     assert_equal(len(np.unique(labels)), 10)
 
+    for n_clusters in range(1, len(X) + 1, 7):
+        clusterer.set_params(n_clusters=n_clusters)
+        expected = hac.fcluster(clusterer.linkage_, n_clusters,
+                                criterion="maxclust")
+        labels = clusterer.labels_
+        assert_equal(len(np.unique(labels)), n_clusters)
+        # Same partition as scipy, up to the numbering of the clusters
+        assert_equal(len(set(zip(labels, expected))), n_clusters)
+
+    # Ties in the merge distances
+    clusterer = ScipyHierarchicalClustering(n_clusters=3)
+    labels = clusterer.fit_predict(np.array([[0.], [0.], [5.], [5.]]))
+    assert_equal(len(np.unique(labels)), 3)
+
 
 def test_shc_threshold():
     """Test changing threshold in SHC."""
@@ -223,6 +431,55 @@ def test_shc_threshold():
     assert_equal(len(np.unique(labels)), 4)
 
 
+def test_shc_predict():
+    """Test assigning new samples to the clusters in SHC."""
+    X, _ = generate_data(supervised=False, affinity=False)
+    X_far = X[:3] + 1000.0
+
+    for method in ("single", "complete", "average"):
+        clusterer = ScipyHierarchicalClustering(method=method, n_clusters=4,
+                                                n_representatives=None)
+        labels = clusterer.fit_predict(X)
+        assert_array_equal(labels, clusterer.predict(X))
+        assert_array_equal([4, 5, 6], clusterer.predict(X_far))
+
+    # Few representatives
+    clusterer = ScipyHierarchicalClustering(method="single", n_clusters=4,
+                                            n_representatives=3)
+    clusterer.fit(X)
+    assert_array_equal([3, 3, 3, 3],
+                       np.bincount(clusterer.representative_labels_))
+    assert_array_equal(clusterer.representative_labels_,
+                       clusterer.predict(clusterer.representatives_))
+
+    # Custom and precomputed affinities
+    clusterer = ScipyHierarchicalClustering(affinity=euclidean_distances,
+                                            threshold=3.0,
+                                            n_representatives=None)
+    labels = clusterer.fit_predict(X)
+    assert_array_equal(labels, clusterer.predict(X))
+
+    # Distances between new samples and representatives only
+    shapes = []
+
+    def cross_affinity(X_new, representatives):
+        shapes.append((len(X_new), len(representatives)))
+        return euclidean_distances(X_new, representatives)
+
+    clusterer.set_params(cross_affinity=cross_affinity)
+    assert_array_equal(labels[:10], clusterer.predict(X[:10]))
+    assert_equal(shapes, [(10, len(X))])
+
+    clusterer = ScipyHierarchicalClustering(affinity="precomputed",
+                                            threshold=3.0,
+                                            n_representatives=None)
+    clusterer.fit(euclidean_distances(X))
+    assert_array_equal(labels, clusterer.predict(euclidean_distances(X)))
+
+    with pytest.raises(ValueError):
+        ScipyHierarchicalClustering(n_clusters=4).fit(X).predict(X)
+
+
 def test_shc_validation():
     """Test the validation of hyper-parameters and input data in SHC"""
     X, _ = generate_data(supervised=False, affinity=False)
@@ -238,3 +495,42 @@ def test_shc_validation():
     with pytest.raises(ValueError):
         clusterer = ScipyHierarchicalClustering(scoring_data="affinity")
         labels = clusterer.fit_predict(X)
+
+
+def test_connected_components_clustering():
+    """Test clustering by connected components under a threshold."""
+    X, _ = generate_data(supervised=False, affinity=False)
+
+    shc = ScipyHierarchicalClustering(method="single", threshold=0.5)
+    labels = shc.fit_predict(X)
+    n_clusters = len(np.unique(labels))
+
+    for chunk_size in (1, 7, 1000):
+        clusterer = ConnectedComponentsClustering(threshold=0.5,
+                                                  chunk_size=chunk_size)
+        # Same partition as single linkage, up to the numbering
+        assert_equal(len(set(zip(labels, clusterer.fit_predict(X)))),
+                     n_clusters)
+        assert_equal(clusterer.n_clusters_, n_clusters)
+        assert clusterer.n_edges_ < len(X) * (len(X) - 1) / 2
+
+    n_edges = clusterer.n_edges_
+
+    # Precomputed, dense or sparse, and callable affinities
+    clusterer.set_params(affinity="precomputed", chunk_size=10)
+    clusterer.fit(euclidean_distances(X))
+    assert_equal(len(set(zip(labels, clusterer.labels_))), n_clusters)
+
+    graph = kneighbors_graph(X, 10, mode="distance")
+    clusterer.fit(graph)
+    assert_equal(len(set(zip(labels, clusterer.labels_))), n_clusters)
+
+    clusterer.set_params(affinity=euclidean_distances)
+    clusterer.fit(X)
+    assert_equal(len(set(zip(labels, clusterer.labels_))), n_clusters)
+    assert_equal(clusterer.n_edges_, n_edges)
+
+    with pytest.raises(ValueError):
+        clusterer.set_params(chunk_size=0).fit(X)
+    with pytest.raises(ValueError):
+        ConnectedComponentsClustering().fit(X)
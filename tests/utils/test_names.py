@@ -20,6 +20,7 @@ import sys
 from beard.ext.metaphone import dm
 
 from beard.utils.names import phonetic_tokenize_name
+from beard.utils.names import phonetic_tokenize_names
 from beard.utils.names import given_name_initial
 from beard.utils.names import given_name
 from beard.utils.names import name_initials
@@ -87,6 +88,19 @@ def test_phonetic_tokenize_name_simple():
         phonetic_tokenize_name("Dupont, Jean")
 
 
+def test_phonetic_tokenize_names():
+    """Test tokenizing many names at once."""
+    names = ["Doe, John", "Dupont, Jean", "Doe, John", "Doe-Foe, J."]
+    inverse, tokens, vocabulary = phonetic_tokenize_names(names)
+
+    assert list(inverse) == [0, 1, 0, 2]
+    assert len(tokens) == 3
+    assert len(vocabulary) == len(set(vocabulary))
+    for name, i in zip(names, inverse):
+        assert phonetic_tokenize_name(name) == tuple(
+            tuple(vocabulary[t] for t in words) for words in tokens[i])
+
+
 @pytest.mark.skipif(sys.version[0] == '3',
                     reason="fuzzy package doesn't work with Python 3")
 def test_phonetic_tokenize_name_python2():